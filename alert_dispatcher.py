@@ -0,0 +1,129 @@
+import asyncio
+import collections
+import logging
+import discord
+from discord.ui import View
+from metrics import REGISTRY
+from profiler import watch_latency
+
+logger = logging.getLogger('discord')
+
+ALERT_WINDOW = 2.0
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARACTERS_PER_MESSAGE = 6000
+SELECT_LABEL_LENGTH = 100
+
+
+class Alert:
+    __slots__ = ('key', 'label', 'embed', 'view')
+
+    def __init__(self, key, label, embed, view):
+        self.key = key
+        self.label = label
+        self.embed = embed
+        self.view = view
+
+
+class AlertDispatcher:
+    '''
+    Outbound queue for mod-channel alerts. Alerts submitted for a channel within `window` seconds of each other
+    are sent together, as many embeds per message as Discord allows. A newer alert for the same key (an abusive
+    user or a targeted entity) replaces the pending one rather than being sent twice. Sending happens on a
+    background task per channel, so detection never waits on Discord's rate limits.
+    '''
+    def __init__(self, window=ALERT_WINDOW, max_embeds=MAX_EMBEDS_PER_MESSAGE):
+        self.window = window
+        self.max_embeds = max_embeds
+        self.pending = {} # Map from channel ID to (channel, OrderedDict from alert key to Alert)
+        self.flush_handles = {}
+        self.senders = {} # Map from channel ID to the task sending that channel's alerts
+        self.outbox = {} # Map from channel ID to batches of alerts waiting to be sent
+
+    def submit(self, channel, key, label, embed, view):
+        REGISTRY.inc('alerts_submitted')
+        _, alerts = self.pending.setdefault(channel.id, (channel, collections.OrderedDict()))
+        if key in alerts:
+            REGISTRY.inc('alerts_deduplicated')
+            del alerts[key]
+        alerts[key] = Alert(key, label, embed, view)
+        if channel.id not in self.flush_handles:
+            self.flush_handles[channel.id] = asyncio.get_running_loop().call_later(self.window, self.flush, channel.id)
+
+    def flush(self, channel_id):
+        self.flush_handles.pop(channel_id, None)
+        channel, alerts = self.pending.pop(channel_id, (None, None))
+        if not alerts:
+            return
+        self.outbox.setdefault(channel_id, collections.deque()).extend(self.pack(list(alerts.values())))
+        sender = self.senders.get(channel_id)
+        if sender is None or sender.done():
+            self.senders[channel_id] = asyncio.ensure_future(self.send_batches(channel))
+
+    def pack(self, alerts):
+        '''
+        Splits alerts into messages of at most `max_embeds` embeds and Discord's total embed size limit.
+        '''
+        batches = []
+        batch = []
+        size = 0
+        for alert in alerts:
+            if batch and (len(batch) == self.max_embeds or size + len(alert.embed) > MAX_EMBED_CHARACTERS_PER_MESSAGE):
+                batches.append(batch)
+                batch = []
+                size = 0
+            batch.append(alert)
+            size += len(alert.embed)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def send_batches(self, channel):
+        outbox = self.outbox[channel.id]
+        while outbox:
+            batch = outbox.popleft()
+            try:
+                with REGISTRY.timer('mod_channel_send'):
+                    if len(batch) == 1:
+                        await channel.send(embed=batch[0].embed, view=batch[0].view)
+                    else:
+                        await channel.send(embeds=[alert.embed for alert in batch], view=CombinedAlertView(batch))
+                REGISTRY.inc('alert_messages_sent')
+            except discord.HTTPException:
+                logger.exception(f'Could not send {len(batch)} alerts to channel {channel.id}')
+
+    async def close(self):
+        for handle in self.flush_handles.values():
+            handle.cancel()
+        for channel_id in list(self.pending):
+            self.flush(channel_id)
+        senders = [sender for sender in self.senders.values() if not sender.done()]
+        if senders:
+            await asyncio.wait(senders)
+
+
+class CombinedAlertView(View):
+    '''
+    View for a message carrying several alerts. A message can only hold one set of buttons, so moderators pick
+    an alert from the menu and its own buttons are posted below.
+    '''
+    def __init__(self, alerts):
+        super().__init__()
+        self.alerts = alerts
+        self.opened = set()
+        self.select = discord.ui.Select(
+            placeholder='Choose an alert to act on',
+            options=[
+                discord.SelectOption(label=alert.label[:SELECT_LABEL_LENGTH], value=str(i))
+                for i, alert in enumerate(alerts)])
+        self.select.callback = self.select_callback
+        self.add_item(self.select)
+
+    @watch_latency
+    async def select_callback(self, interaction):
+        i = int(self.select.values[0])
+        alert = self.alerts[i]
+        if i in self.opened:
+            await interaction.response.send_message(f'Actions for {alert.label} are already open above.', ephemeral=True)
+            return
+        self.opened.add(i)
+        await interaction.response.send_message(content=f'Actions for {alert.label}:', view=alert.view)
@@ -0,0 +1,264 @@
+'''
+Micro-benchmarks for the detection hot path. Perspective is replaced by a local stand-in server with configurable
+latency, so the numbers measure the bot rather than the network. Results are written as JSON so runs from
+different releases can be compared.
+
+    python benchmark.py --latency 0.05 --messages 2000 --output benchmark_results.json
+'''
+import argparse
+import asyncio
+import json
+import platform
+import random
+import time
+import numpy as np
+from aiohttp import web
+from mention_records import IncomingMessage, MentionRecord
+from message_processor import MessageProcessor, ScoringServices
+from perspective_client import PERSPECTIVE_ATTRIBUTES
+from prefilter import ABUSIVE_LEXICON, SECOND_PERSON
+
+BENCHMARK_OUTPUT = 'benchmark_results.json'
+BENCHMARK_LATENCY = 0.05
+BENCHMARK_MESSAGES = 2000
+BENCHMARK_CONCURRENCY = 64
+LEDGER_SIZES = [1000, 10000, 100000]
+USER_COUNTS = [100, 1000, 10000]
+EMBED_SIZES = [5, 50, 200]
+
+NEUTRAL_WORDS = [
+    'the', 'game', 'last', 'night', 'was', 'great', 'i', 'think', 'we', 'should', 'watch', 'it', 'again', 'what',
+    'about', 'new', 'album', 'really', 'good', 'lol', 'tomorrow', 'meeting', 'at', 'noon', 'thanks', 'for',
+    'help', 'agree', 'with', 'that', 'take', 'is', 'wild', 'honestly', 'never', 'seen', 'anything', 'like',
+]
+ENTITY_NAMES = ['Ben Shapiro', 'Taylor Swift', 'Joe Biden', 'Elon Musk', 'Serena Williams', 'Americans']
+ABUSIVE_WORDS = sorted(ABUSIVE_LEXICON)
+
+
+class PerspectiveStandIn:
+    '''
+    Local server that answers Perspective requests after a fixed delay. Scores rise with the share of lexicon
+    words in the text, so roughly the same messages come back abusive on every run.
+    '''
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.runner = None
+        self.url = None
+
+    async def analyze(self, request):
+        self.requests += 1
+        body = json.loads(await request.text())
+        words = body['comment']['text'].lower().split()
+        toxicity = min(1.0, 4 * sum(1 for word in words if word in ABUSIVE_LEXICON) / max(len(words), 1))
+        await asyncio.sleep(self.latency)
+        return web.json_response({
+            'attributeScores': {attr: {'summaryScore': {'value': toxicity}} for attr in body['requestedAttributes']}
+        })
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/v1alpha1/comments:analyze', self.analyze)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f'http://127.0.0.1:{port}/v1alpha1/comments:analyze'
+
+    async def close(self):
+        await self.runner.cleanup()
+
+
+def synthetic_text(rng, abusive_rate=0.2):
+    words = rng.choices(NEUTRAL_WORDS, k=rng.randint(4, 20))
+    if rng.random() < 0.5:
+        words.insert(rng.randrange(len(words)), rng.choice(ENTITY_NAMES))
+    if rng.random() < abusive_rate:
+        words.insert(0, rng.choice(sorted(SECOND_PERSON)))
+        for _ in range(rng.randint(1, 3)):
+            words.insert(rng.randrange(len(words)), rng.choice(ABUSIVE_WORDS))
+    return ' '.join(words)
+
+
+def synthetic_messages(rng, count, users=200):
+    now = time.time()
+    return [
+        IncomingMessage(i, 1, 1, rng.randrange(users), now, synthetic_text(rng))
+        for i in range(count)]
+
+
+def latency_summary(samples):
+    samples = np.asarray(samples)
+    return {
+        'count': len(samples),
+        'mean_ms': float(samples.mean() * 1000),
+        'p50_ms': float(np.percentile(samples, 50) * 1000),
+        'p99_ms': float(np.percentile(samples, 99) * 1000),
+        'max_ms': float(samples.max() * 1000),
+    }
+
+
+def time_calls(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return latency_summary(samples)
+
+
+async def bench_process_message(services, tokens, rng, count, concurrency):
+    processor = MessageProcessor(tokens, services=services)
+    messages = synthetic_messages(rng, count)
+    semaphore = asyncio.Semaphore(concurrency)
+    samples = []
+
+    async def run(message):
+        async with semaphore:
+            start = time.perf_counter()
+            await processor.process_message(message)
+            samples.append(time.perf_counter() - start)
+
+    # Warm the NER workers so model loading isn't counted as latency
+    await processor.eval_entities('warm up')
+    start = time.perf_counter()
+    await asyncio.gather(*(run(message) for message in messages))
+    elapsed = time.perf_counter() - start
+    result = latency_summary(samples)
+    result.update({
+        'concurrency': concurrency,
+        'messages_per_second': count / elapsed,
+        'prefilter': dict(processor.prefilter.stats),
+        'score_cache': dict(services.score_cache.stats),
+    })
+    await processor.close()
+    return result
+
+
+async def bench_eval_entities(services, tokens, rng, count):
+    processor = MessageProcessor(tokens, services=services)
+    texts = [synthetic_text(rng) for _ in range(count)]
+    samples = []
+    for text in texts[:count // 10]:
+        start = time.perf_counter()
+        await processor.eval_entities(text)
+        samples.append(time.perf_counter() - start)
+    sequential = latency_summary(samples)
+    start = time.perf_counter()
+    await asyncio.gather(*(processor.eval_entities(text) for text in texts))
+    elapsed = time.perf_counter() - start
+    await processor.close()
+    return {'sequential': sequential, 'batched_messages_per_second': count / elapsed}
+
+
+def fill_ledger(processor, rng, documents, users):
+    '''
+    Feeds pre-tokenized messages straight into the detection state, bypassing NER and Perspective.
+    '''
+    scores = {attr: 0 for attr in PERSPECTIVE_ATTRIBUTES}
+    abusive_scores = {attr: 0.9 for attr in PERSPECTIVE_ATTRIBUTES}
+    now = time.time()
+    for i in range(documents):
+        text = synthetic_text(rng)
+        abusive = any(word in ABUSIVE_LEXICON for word in text.split())
+        entities = {name for name in ENTITY_NAMES if name in text}
+        processor.apply_message(
+            MentionRecord(i, 1, 1, rng.randrange(users), now, text), b'', text.lower().split(), entities,
+            abusive_scores if abusive else scores, [])
+
+
+def bench_tf_idf(services, tokens, rng, repeat):
+    results = {}
+    for size in LEDGER_SIZES:
+        processor = MessageProcessor(tokens, services=services)
+        fill_ledger(processor, rng, size, users=200)
+        results[str(size)] = time_calls(lambda: processor.compute_tf_idf_by_token(ENTITY_NAMES[0]), repeat)
+    return results
+
+
+def bench_thresholds(services, tokens, rng, repeat):
+    results = {}
+    for users in USER_COUNTS:
+        processor = MessageProcessor(tokens, services=services)
+        fill_ledger(processor, rng, 2 * users, users=users)
+        start = time.perf_counter()
+        processor.user_abuse_threshold_exceeded()
+        processor.entity_abuse_threshold_exceeded()
+        all_dirty = time.perf_counter() - start
+        # Steady state: one new message between checks, with only the checks timed
+        samples = []
+        for _ in range(repeat):
+            fill_ledger(processor, rng, 1, users=users)
+            start = time.perf_counter()
+            processor.user_abuse_threshold_exceeded()
+            processor.entity_abuse_threshold_exceeded()
+            samples.append(time.perf_counter() - start)
+        results[str(users)] = {'all_dirty_ms': all_dirty * 1000, 'per_message': latency_summary(samples)}
+    return results
+
+
+def bench_embeds(rng, repeat):
+    from embed_views import AbuseWarningEmbed, TargetedWarningEmbed, group_by_author
+    results = {}
+    now = time.time()
+    for size in EMBED_SIZES:
+        records = [
+            MentionRecord(i, 1, 1, rng.randrange(max(size // 5, 1)), now, synthetic_text(rng, abusive_rate=1))
+            for i in range(size)]
+        results[str(size)] = {
+            'abuse_warning': time_calls(lambda: AbuseWarningEmbed(records), repeat),
+            'targeted_warning': time_calls(lambda: TargetedWarningEmbed(ENTITY_NAMES[0], group_by_author(records)), repeat),
+        }
+    return results
+
+
+async def run_benchmarks(args):
+    rng = random.Random(args.seed)
+    server = PerspectiveStandIn(args.latency)
+    await server.start()
+    tokens = {
+        'perspective': 'benchmark',
+        'perspective_url': server.url,
+        'perspective_qps': args.qps,
+        'score_cache_path': None,
+        'state_dir': None,
+    }
+    services = ScoringServices(tokens)
+    results = {
+        'started_at': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': vars(args),
+    }
+    try:
+        results['process_message'] = await bench_process_message(services, tokens, rng, args.messages, args.concurrency)
+        results['perspective_requests'] = server.requests
+        results['eval_entities'] = await bench_eval_entities(services, tokens, rng, args.messages)
+        results['compute_tf_idf_by_token'] = bench_tf_idf(services, tokens, rng, args.repeat)
+        results['threshold_checks'] = bench_thresholds(services, tokens, rng, args.repeat)
+        results['embeds'] = bench_embeds(rng, args.repeat)
+    finally:
+        await services.close()
+        await server.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the detection hot path against a local Perspective stand-in')
+    parser.add_argument('--latency', type=float, default=BENCHMARK_LATENCY, help='stand-in response delay in seconds')
+    parser.add_argument('--qps', type=float, default=1000, help='Perspective QPS budget for the scheduler')
+    parser.add_argument('--messages', type=int, default=BENCHMARK_MESSAGES)
+    parser.add_argument('--concurrency', type=int, default=BENCHMARK_CONCURRENCY)
+    parser.add_argument('--repeat', type=int, default=100, help='repetitions for the synchronous benchmarks')
+    parser.add_argument('--seed', type=int, default=152)
+    parser.add_argument('--output', default=BENCHMARK_OUTPUT)
+    args = parser.parse_args()
+    results = asyncio.run(run_benchmarks(args))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
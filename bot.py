@@ -1,4 +1,5 @@
 # bot.py
+import asyncio
 import discord
 from discord.ext import commands
 import os
@@ -6,41 +7,94 @@ import json
 import logging
 import re
 import requests
+import time
 from datetime import datetime
 from uuid import uuid4
 from report import Report
 from manual_review import ManualReview
-from message_processor import MessageProcessor
-from embed_views import AbuseWarningView, AbuseWarningEmbed, TargetedWarningView, TargetedWarningEmbed, DetectedKeywordsView, DetectedKeywordsEmbed
+from mention_records import IncomingMessage
+from processor_pool import ProcessorPool, ProcessorPoolError
+from ingestion_queue import IngestionQueue, INGESTION_QUEUE_SIZE, INGESTION_CONSUMERS
+from prefilter import CascadeFilter
+from alert_dispatcher import AlertDispatcher, ALERT_WINDOW
+from bulk_delete import BulkDeleter
+from warning_fanout import WarningFanout, WARNING_DEDUPE_WINDOW
+from message_cache import MessageCache, MESSAGE_CACHE_SIZE
+from metrics import REGISTRY, MetricsServer, METRICS_PORT, merge_snapshots, format_stats, split_message
+from profiler import LoopWatchdog, profile_for, set_slow_callback_budget, watch_latency, SLOW_CALLBACK_BUDGET, PROFILE_MAX_SECONDS
+from uni2ascii import uni2ascii
+from embed_views import AbuseWarningView, AbuseWarningEmbed, TargetedWarningView, TargetedWarningEmbed, DetectedKeywordsView, DetectedKeywordsEmbed, group_by_author
 
-# Set up logging to the console
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
-
-# There should be a file called 'tokens.json' inside the same folder as this file
-token_path = 'tokens.json'
-if not os.path.isfile(token_path):
-    raise Exception(f"{token_path} not found!")
-with open(token_path) as f:
-    # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
-    tokens = json.load(f)
-    discord_token = tokens['discord']
-    perspective_key = tokens['perspective']
+
+def setup_logging():
+    # Set up logging to the console
+    logger.setLevel(logging.DEBUG)
+    handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    logger.addHandler(handler)
+
+def read_tokens():
+    # There should be a file called 'tokens.json' inside the same folder as this file
+    token_path = 'tokens.json'
+    if not os.path.isfile(token_path):
+        raise Exception(f"{token_path} not found!")
+    with open(token_path) as f:
+        # If you get an error here, it means your token is formatted incorrectly. Did you put it in quotes?
+        return json.load(f)
 
 
 class ModBot(discord.Client):
-    def __init__(self, key):
+    def __init__(self, tokens):
         intents = discord.Intents.default()
         super().__init__(command_prefix='.', intents=intents)
+        self.started_at = time.monotonic()
         self.group_num = None
         self.mod_channels = {} # Map from guild to the mod channel id for that guild
         self.reports = {} # Map from case ID to the state of their report
         self.manual_reviews = {} # Map from case ID to a manual review corresponding to their
-        self.perspective_key = key
-        self.message_processor = MessageProcessor()
+        self.perspective_key = tokens['perspective']
+        self.processor_pool = ProcessorPool(tokens) # Detection state, sharded by guild across worker processes
+        self.processor_pool.start()
+        self.triage_filter = CascadeFilter() # Only used to decide which messages to shed under load
+        self.ingestion_queue = IngestionQueue(
+            self.detect_abuse,
+            self.triage_message,
+            capacity=tokens.get('ingestion_queue_size', INGESTION_QUEUE_SIZE),
+            consumers=tokens.get('ingestion_consumers', INGESTION_CONSUMERS))
+        # Messages are buffered until the workers have warmed up, then scored in arrival order
+        self.ingestion_queue.pause()
+        self.warm_up_task = None
+        self.alert_dispatcher = AlertDispatcher(window=tokens.get('alert_window', ALERT_WINDOW))
+        self.bulk_deleter = BulkDeleter(self)
+        self.warning_fanout = WarningFanout(self, dedupe_window=tokens.get('warning_dedupe_window', WARNING_DEDUPE_WINDOW))
+        # Guild messages seen over the gateway, so report links resolve without a REST fetch
+        self.message_cache = MessageCache(tokens.get('message_cache_size', MESSAGE_CACHE_SIZE))
+        REGISTRY.gauge_callback('message_cache', lambda: dict(self.message_cache.stats, entries=len(self.message_cache)))
+        REGISTRY.gauge_callback('ingestion_queue_depth', self.ingestion_queue.depth)
+        REGISTRY.gauge_callback('ingestion_lag_seconds', self.ingestion_queue.lag)
+        REGISTRY.gauge_callback('ingestion', lambda: dict(self.ingestion_queue.stats))
+        metrics_port = tokens.get('metrics_port', METRICS_PORT)
+        self.metrics_server = MetricsServer(self.collect_metrics, port=metrics_port) if metrics_port is not None else None
+        set_slow_callback_budget(tokens.get('slow_callback_budget', SLOW_CALLBACK_BUDGET))
+        self.watchdog = LoopWatchdog(tokens.get('slow_callback_budget', SLOW_CALLBACK_BUDGET))
+
+    async def start(self, *args, **kwargs):
+        # Warm up the detection workers while the gateway connects, instead of on the first message
+        self.warm_up_task = asyncio.ensure_future(self.warm_up())
+        await super().start(*args, **kwargs)
+
+    async def warm_up(self):
+        try:
+            worker_time = await self.processor_pool.warm_up()
+            logger.info(f'Processor workers warmed up (slowest took {worker_time:.1f}s)')
+        except ProcessorPoolError:
+            logger.exception('Processor warm-up failed; starting detection anyway')
+        time_to_ready = time.monotonic() - self.started_at
+        REGISTRY.set_gauge('time_to_ready_seconds', time_to_ready)
+        logger.info(f'Detection ready {time_to_ready:.1f}s after startup, {self.ingestion_queue.depth()} messages buffered')
+        print(f'Detection is ready ({time_to_ready:.1f}s after startup).')
+        self.ingestion_queue.resume()
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It\'s in these guilds:')
@@ -58,23 +112,60 @@ class ModBot(discord.Client):
             for channel in guild.text_channels:
                 if channel.name == f'group-{self.group_num}-mod':
                     self.mod_channels[guild.id] = channel
+        # Restore each guild's detection state now rather than on its first message
+        asyncio.ensure_future(self.processor_pool.open_shards([guild.id for guild in self.guilds]))
+        # on_ready fires again after reconnects, so only start the metrics endpoint once
+        if self.metrics_server is not None and self.metrics_server.runner is None:
+            await self.metrics_server.start()
+        if self.watchdog.thread is None:
+            self.watchdog.start()
+
+    async def close(self):
+        self.watchdog.stop()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
+        await self.ingestion_queue.close()
+        await self.alert_dispatcher.close()
+        await self.processor_pool.close()
+        await super().close()
 
+    @watch_latency
     async def on_message(self, message):
         '''
         This function is called whenever a message is sent in a channel that the bot can see (including DMs).
         Currently the bot is configured to only handle messages that are sent over DMs or in your group's "group-#" channel.
         '''
+        if message.guild:
+            self.message_cache.add(message)
         # Ignore messages from us
         if message.author.id == self.user.id:
             return
         # Check if this message was sent in a server ("guild") or if it's a DM
-        if message.guild:
+        if message.guild and message.channel == self.mod_channels.get(message.guild.id):
+            await self.handle_mod_message(message)
+        elif message.guild:
             await self.handle_channel_message(message)
         else:
             await self.handle_dm(message)
 
+    async def on_raw_message_edit(self, payload):
+        # Raw events fire even for messages discord.py didn't cache; on_message_edit re-adds the new version
+        self.message_cache.invalidate(payload.message_id)
+
+    async def on_raw_message_delete(self, payload):
+        self.message_cache.invalidate(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            self.message_cache.invalidate(message_id)
+
+    @watch_latency
     async def on_message_edit(self, message_before, message_after):
-        await self.handle_channel_message(message_after)
+        if message_after.guild:
+            self.message_cache.add(message_after)
+        # Embed and pin updates also arrive as edits; only rescore when the text changed
+        if message_after.guild and message_before.content != message_after.content:
+            await self.handle_channel_message(message_after, edited=True)
 
     async def handle_dm(self, message):
         # Handle a help message
@@ -108,32 +199,99 @@ class ModBot(discord.Client):
                 reporting_channel=message.channel)
             await self.manual_reviews[manual_review_case_id].initial_message()
 
-    async def handle_channel_message(self, message):
+    async def handle_mod_message(self, message):
+        if message.content.strip().startswith('profile'):
+            await self.handle_profile_command(message)
+        elif message.content.strip() == 'stats':
+            merged = merge_snapshots(await self.collect_metrics())
+            # Discord caps messages at 2000 characters, so send the report in line-aligned chunks
+            for chunk in split_message(format_stats(merged)):
+                await message.channel.send(chunk)
+
+    async def handle_profile_command(self, message):
+        '''
+        `profile N` samples the bot and every processor worker for N seconds and reports where the profiles were
+        written.
+        '''
+        match = re.fullmatch(r'profile\s+(\d+)', message.content.strip())
+        if not match:
+            await message.channel.send('Usage: `profile <seconds>`')
+            return
+        seconds = min(int(match.group(1)), PROFILE_MAX_SECONDS)
+        await message.channel.send(f'Profiling the bot and its workers for {seconds}s...')
+        bot_profile, worker_profiles = await asyncio.gather(
+            profile_for(seconds, 'bot'),
+            self.processor_pool.profile(seconds))
+        reply = 'Profiles written:\n'
+        for name, (path, samples) in [('bot', bot_profile)] + sorted(worker_profiles.items()):
+            reply += f'{name}: `{path}` ({samples} samples)\n'
+        await message.channel.send(reply)
+
+    async def collect_metrics(self):
+        '''
+        Returns metrics snapshots for the bot and every processor worker, keyed by process.
+        '''
+        snapshots = {'bot': REGISTRY.snapshot()}
+        snapshots.update(await self.processor_pool.metrics())
+        return snapshots
+
+    async def handle_channel_message(self, message, edited=False):
         # Only handle messages sent in the "group-#" channel
         if not message.channel.name == f'group-{self.group_num}':
             return
+        # Detection runs off the ingestion queue so that a flood of channel messages can't stall DMs or buttons
+        self.ingestion_queue.put(message, edited)
+
+    def triage_message(self, message):
+        '''
+        Returns whether the message looks benign and whether it contains flagged keywords, for load shedding.
+        '''
+        content = uni2ascii(message.content)
+        tokenized_message = re.findall(r"[\w']+", content.lower())
+        flagged = len(self.processor_pool.flagged_matcher(message.guild.id).match(tokenized_message)) > 0
+        benign = self.triage_filter.local_score(content, tokenized_message) < self.triage_filter.threshold
+        return benign, flagged
+
+    async def detect_abuse(self, message, edited=False):
         mod_channel = self.mod_channels[message.guild.id]
         # process the message content
-        self.message_processor.process_message(message)
-        # identify and warn against abusive users
-        abusive_users = self.message_processor.user_abuse_threshold_exceeded()
-        if len(abusive_users) > 0:
-            for user, messages in abusive_users:
-                await mod_channel.send(
-                    embed=AbuseWarningEmbed(messages),
-                    view=AbuseWarningView(messages))
+        with REGISTRY.timer('detection_round_trip'):
+            abusive_users, targeted_entities = await self.processor_pool.process_message(IncomingMessage.from_message(message), edited)
+        # identify and warn against abusive users; alerts are coalesced and sent in the background
+        for user, messages in abusive_users:
+            user_name = self.get_user(user) or user
+            embed = AbuseWarningEmbed(messages)
+            self.alert_dispatcher.submit(
+                mod_channel,
+                ('user', user),
+                f'Abusive user {user_name}',
+                embed,
+                AbuseWarningView(messages, self, embed=embed))
+            REGISTRY.inc('abuse_alerts')
         # identity and warn about targeted entities
-        targeted_entities = self.message_processor.entity_abuse_threshold_exceeded()
-        if len(targeted_entities) > 0:
-            for entity, mentions in targeted_entities:
-                await mod_channel.send(
-                    embed=TargetedWarningEmbed(entity, mentions),
-                    view=TargetedWarningView(
-                        mentions,
-                        entity,
-                        self.message_processor,
-                        mod_channel.send))
-
-
-client = ModBot(perspective_key)
-client.run(discord_token)
+        for entity, mentions in targeted_entities:
+            # Grouped once and shared by the embed and its view
+            mentions_by_user = group_by_author(mentions)
+            embed = TargetedWarningEmbed(entity, mentions_by_user)
+            self.alert_dispatcher.submit(
+                mod_channel,
+                ('entity', entity),
+                f'Targeted harassment of {entity}',
+                embed,
+                TargetedWarningView(
+                    mentions,
+                    entity,
+                    self.processor_pool.guild(message.guild.id),
+                    mod_channel.send,
+                    self,
+                    mentions_by_user=mentions_by_user,
+                    embed=embed))
+            REGISTRY.inc('targeted_alerts')
+
+
+if __name__ == '__main__':
+    # Guarded so that the spawned worker processes can import this module without starting the bot
+    setup_logging()
+    tokens = read_tokens()
+    client = ModBot(tokens)
+    client.run(tokens['discord'])
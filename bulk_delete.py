@@ -0,0 +1,127 @@
+import asyncio
+import datetime
+import logging
+import time
+import discord
+from metrics import REGISTRY
+
+logger = logging.getLogger('discord')
+
+BULK_DELETE_LIMIT = 100
+# Discord rejects bulk deletes of messages older than 14 days; leave a margin for clock skew
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+SINGLE_DELETE_CONCURRENCY = 5
+PROGRESS_INTERVAL = 1.0
+
+
+class DeletionReport:
+    __slots__ = ('deleted', 'not_found', 'failed')
+
+    def __init__(self):
+        self.deleted = set() # IDs of messages deleted by this run
+        self.not_found = 0
+        self.failed = 0
+
+    def summary(self):
+        summary = f'Deleted {len(self.deleted)} messages'
+        if self.not_found:
+            summary += f', {self.not_found} were already gone'
+        if self.failed:
+            summary += f', {self.failed} could not be deleted'
+        return summary + '.'
+
+
+def deletion_target(item):
+    '''
+    Returns (channel ID, message ID) for a discord.Message or a MentionRecord.
+    '''
+    if isinstance(item, discord.Message):
+        return item.channel.id, item.id
+    return item.channel_id, item.message_id
+
+
+class BulkDeleter:
+    '''
+    Deletes many messages in as few API calls as possible. Messages are grouped by channel, those younger than
+    14 days are removed with bulk deletes of up to 100 at a time, and only older messages, or batches that
+    Discord rejects, fall back to deleting one message at a time. `progress`, if given, is awaited with
+    (done, total) at most once a second and once at the end.
+    '''
+    def __init__(self, client):
+        self.client = client
+
+    async def delete(self, items, progress=None):
+        report = DeletionReport()
+        by_channel = {}
+        for item in items:
+            channel_id, message_id = deletion_target(item)
+            by_channel.setdefault(channel_id, set()).add(message_id)
+        total = sum(len(message_ids) for message_ids in by_channel.values())
+        done = 0
+        last_progress = time.monotonic()
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        for channel_id, message_ids in by_channel.items():
+            channel = self.client.get_channel(channel_id)
+            if channel is None:
+                try:
+                    channel = await self.client.fetch_channel(channel_id)
+                except discord.HTTPException:
+                    report.not_found += len(message_ids)
+                    done += len(message_ids)
+                    continue
+            recent = sorted(i for i in message_ids if discord.utils.snowflake_time(i) > cutoff)
+            old = sorted(message_ids.difference(recent))
+            for start in range(0, len(recent), BULK_DELETE_LIMIT):
+                batch = recent[start:start + BULK_DELETE_LIMIT]
+                if len(batch) > 1 and await self.bulk_delete(channel, batch):
+                    report.deleted.update(batch)
+                else:
+                    await self.delete_individually(channel, batch, report)
+                done += len(batch)
+                if progress is not None and time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await progress(done, total)
+            await self.delete_individually(channel, old, report)
+            done += len(old)
+        if progress is not None:
+            await progress(done, total)
+        return report
+
+    async def bulk_delete(self, channel, message_ids):
+        try:
+            await channel.delete_messages([discord.Object(id=message_id) for message_id in message_ids])
+        except discord.HTTPException as err:
+            # Usually missing Manage Messages, or a message that was already deleted
+            logger.warning(f'Bulk delete of {len(message_ids)} messages in channel {channel.id} failed: {err}')
+            return False
+        REGISTRY.inc('bulk_deletes')
+        return True
+
+    async def delete_individually(self, channel, message_ids, report):
+        semaphore = asyncio.Semaphore(SINGLE_DELETE_CONCURRENCY)
+
+        async def delete_one(message_id):
+            async with semaphore:
+                try:
+                    await channel.get_partial_message(message_id).delete()
+                    report.deleted.add(message_id)
+                    REGISTRY.inc('single_deletes')
+                except discord.NotFound:
+                    report.not_found += 1
+                except discord.HTTPException:
+                    logger.exception(f'Could not delete message {message_id} in channel {channel.id}')
+                    report.failed += 1
+
+        await asyncio.gather(*(delete_one(message_id) for message_id in message_ids))
+
+
+def interaction_progress(interaction):
+    '''
+    Returns a progress callback that shows deletion progress on the interaction's original message.
+    '''
+    async def progress(done, total):
+        try:
+            await interaction.edit_original_message(content=f'Deleting messages... {done}/{total}')
+        except discord.HTTPException:
+            pass
+    return progress
@@ -1,77 +1,98 @@
 import discord
 from discord.ui import View
+from profiler import watch_latency
+from bulk_delete import interaction_progress
+
+EMBED_DESCRIPTION_LIMIT = 4096
 
 class AbuseWarningView(View):
-    def __init__(self, messages):
+    def __init__(self, messages, client, embed=None):
         super().__init__()
         self.messages = messages
-        self.user = messages[0].author
-        self.channel = messages[0].channel
+        self.client = client
+        self.user_id = messages[0].author_id
+        self.channel_id = messages[0].channel_id
+        if embed is not None:
+            add_page_buttons(self, embed)
 
     @discord.ui.button(label='Send warning', style=discord.ButtonStyle.blurple)
+    @watch_latency
     async def send_warning_callback(self, button, interaction):
         await interaction.response.defer()
         button.label = 'Warning sent'
         button.disabled = True
-        warning_message = (
-            f"This is a warning from the moderators of `{self.channel.name}`.\n"
-            f"We've flagged your messages as abusive content.\n"
-            "Please refrain from using abusive language in the channel.")
-        await self.user.send(embed=AbuseWarningEmbed(self.messages))
-        await self.user.send(content=warning_message)
-        await interaction.edit_original_message(view=self)
+        channel = await resolve_channel(self.client, self.channel_id)
+        report = await self.client.warning_fanout.send(
+            self.channel_id, [(self.user_id, warning_message(channel), AbuseWarningEmbed(self.messages))])
+        await interaction.edit_original_message(content=report.summary(), view=self)
 
     @discord.ui.button(label='Delete all messages', style=discord.ButtonStyle.gray)
+    @watch_latency
     async def delete_message_callback(self, button, interaction):
         await interaction.response.defer()
-        button.label = 'Messages deleted'
+        button.label = 'Deleting messages...'
         button.disabled = True
-        for message in self.messages:
-            try:
-                await message.delete()
-            except discord.errors.NotFound as err:
-                pass
         await interaction.edit_original_message(view=self)
+        report = await self.client.bulk_deleter.delete(self.messages, progress=interaction_progress(interaction))
+        button.label = 'Messages deleted'
+        await interaction.edit_original_message(content=report.summary(), view=self)
 
     @discord.ui.button(label='Kick user', style=discord.ButtonStyle.red)
+    @watch_latency
     async def kick_user_callback(self, button, interaction):
         await interaction.response.defer()
         button.label = 'User kicked'
         button.disabled = True
-        await self.channel.send(f'{self.user.name} has been kicked.') # simulate user being kicked
+        user = await resolve_user(self.client, self.user_id)
+        channel = await resolve_channel(self.client, self.channel_id)
+        await channel.send(f'{user.name} has been kicked.') # simulate user being kicked
         await interaction.edit_original_message(view=self)
 
-class AbuseWarningEmbed(discord.Embed):
+class PagedEmbed(discord.Embed):
+    '''
+    Embed whose description is split into pages under Discord's description limit, showing one page at a time.
+    '''
+    def __init__(self, title, lines, color):
+        self.pages = paginate(lines)
+        self.page = 0
+        super().__init__(title=title, description=self.pages[0], color=color)
+
+    def show_page(self, page):
+        self.page = page % len(self.pages)
+        self.description = self.pages[self.page]
+        self.set_footer(text=f'Page {self.page + 1} of {len(self.pages)}')
+
+class AbuseWarningEmbed(PagedEmbed):
     def __init__(self, messages):
-        title = 'Abusive user detected'
-        description = f'<@{messages[0].author.id}> said:'
+        lines = [f'<@{messages[0].author_id}> said:']
         time = None
         for message in messages:
-            if time != message.created_at.strftime("%b %-m, %Y"):
-                time = message.created_at.strftime("%b %-m, %Y")
-                description += f'\n{time}\n'
-            description += f'"{truncate_string(message.content)}" [[link]({message.jump_url})]\n\n'
-        super().__init__(title=title, description=description, color=0xFFA500)
+            if time != message.created_datetime.strftime("%b %-m, %Y"):
+                time = message.created_datetime.strftime("%b %-m, %Y")
+                lines.append(f'\n{time}\n')
+            lines.append(f'"{truncate_string(message.content)}" [[link]({message.jump_url})]\n\n')
+        super().__init__('Abusive user detected', lines, color=0xFFA500)
 
 
 class TargetedWarningView(View):
-    def __init__(self, mentions, entity, message_processor, send_to_mod_channel):
+    def __init__(self, mentions, entity, message_processor, send_to_mod_channel, client, mentions_by_user=None, embed=None):
         super().__init__()
         self.mentions = mentions
         self.entity = entity
         self.message_processor = message_processor
         self.send_to_mod_channel = send_to_mod_channel
-        self.channel = mentions[0]['original_message'].channel
-        self.mentions_by_user = {}
-        for mention_obj in mentions:
-            user = mention_obj['original_message'].author
-            message = mention_obj['original_message']
-            self.mentions_by_user[user] = self.mentions_by_user.get(user, []) + [message]
+        self.client = client
+        self.channel_id = mentions[0].channel_id
+        # Map from author ID to that author's MentionRecords, shared with the embed when the caller grouped them
+        self.mentions_by_user = mentions_by_user if mentions_by_user is not None else group_by_author(mentions)
+        if embed is not None:
+            add_page_buttons(self, embed)
 
     @discord.ui.button(label='See associated keywords', style=discord.ButtonStyle.green)
+    @watch_latency
     async def see_words_callback(self, button, interaction):
         await interaction.response.defer()
-        detected_keywords = self.message_processor.compute_tf_idf_by_token(self.mentions)
+        detected_keywords = await self.message_processor.compute_tf_idf_by_token(self.entity)
         button.label = 'No keywords detected'
         button.disabled = True
         if len(detected_keywords) > 0:
@@ -82,55 +103,46 @@ class TargetedWarningView(View):
         await interaction.edit_original_message(view=self)
 
     @discord.ui.button(label='Send warnings', style=discord.ButtonStyle.blurple)
+    @watch_latency
     async def send_warning_callback(self, button, interaction):
         await interaction.response.defer()
         button.label = 'Warnings sent'
         button.disabled = True
-        warning_message = (
-            f"This is a warning from the moderators of `{self.channel.name}`.\n"
-            f"We've flagged your messages as abusive content.\n"
-            "Please refrain from using abusive language in the channel.")
-        for user, messages in self.mentions_by_user.items():
-            await user.send(embed=AbuseWarningEmbed(messages))
-            await user.send(content=warning_message)
-        await interaction.edit_original_message(view=self)
+        content = warning_message(await resolve_channel(self.client, self.channel_id))
+        report = await self.client.warning_fanout.send(
+            self.channel_id, [(user_id, content, AbuseWarningEmbed(messages)) for user_id, messages in self.mentions_by_user.items()])
+        await interaction.edit_original_message(content=report.summary(), view=self)
 
     @discord.ui.button(label='Delete all messages', style=discord.ButtonStyle.gray)
+    @watch_latency
     async def delete_message_callback(self, button, interaction):
         await interaction.response.defer()
-        button.label = 'Messages deleted'
+        button.label = 'Deleting messages...'
         button.disabled = True
-        for _, messages in self.mentions_by_user.items():
-            for message in messages:
-                try:
-                    await message.delete()
-                except discord.errors.NotFound as err:
-                    pass
         await interaction.edit_original_message(view=self)
+        report = await self.client.bulk_deleter.delete(self.mentions, progress=interaction_progress(interaction))
+        button.label = 'Messages deleted'
+        await interaction.edit_original_message(content=report.summary(), view=self)
 
     @discord.ui.button(label='Kick users', style=discord.ButtonStyle.red)
+    @watch_latency
     async def kick_user_callback(self, button, interaction):
         await interaction.response.defer()
         button.label = 'Users kicked'
         button.disabled = True
-        for user, _ in self.mentions_by_user.items():
-            await self.channel.send(f'{user.name} has been kicked.') # simulate user being kicked
+        channel = await resolve_channel(self.client, self.channel_id)
+        for user_id, _ in self.mentions_by_user.items():
+            user = await resolve_user(self.client, user_id)
+            await channel.send(f'{user.name} has been kicked.') # simulate user being kicked
         await interaction.edit_original_message(view=self)
 
-class TargetedWarningEmbed(discord.Embed):
-    def __init__(self, entity, mentions):
-        mentions_by_user = {}
-        for mention_obj in mentions:
-            user = mention_obj['original_message'].author
-            message = mention_obj['original_message']
-            mentions_by_user[user] = mentions_by_user.get(user, []) + [message]
-        title = 'Targeted harassment detected'
-        description = f'Here are abusive messages mentioning the entity: `{entity}`.\n'
-        for user, messages in mentions_by_user.items():
-            description += f'<@{user.id}> said:\n'
-            for message in messages:
-                description += f'"{truncate_string(message.content)}" [[link]({message.jump_url})]\n\n'
-        super().__init__(title=title, description=description, color=0xED1500)
+class TargetedWarningEmbed(PagedEmbed):
+    def __init__(self, entity, mentions_by_user):
+        lines = [f'Here are abusive messages mentioning the entity: `{entity}`.\n']
+        for user_id, messages in mentions_by_user.items():
+            lines.append(f'<@{user_id}> said:\n')
+            lines.extend(f'"{truncate_string(message.content)}" [[link]({message.jump_url})]\n\n' for message in messages)
+        super().__init__('Targeted harassment detected', lines, color=0xED1500)
 
 
 class DetectedKeywordsView(View):
@@ -140,11 +152,12 @@ class DetectedKeywordsView(View):
         self.message_processor = message_processor
 
     @discord.ui.button(label='Flag keywords in chat', style=discord.ButtonStyle.red)
+    @watch_latency
     async def callback(self, button, interaction):
         await interaction.response.defer()
         button.label = 'Keywords will be flagged'
         button.disabled = True
-        self.message_processor.update_flagged_tokens(self.detected_keywords)
+        await self.message_processor.update_flagged_tokens(self.detected_keywords)
         await interaction.edit_original_message(view=self)
 
 class DetectedKeywordsEmbed(discord.Embed):
@@ -155,6 +168,70 @@ class DetectedKeywordsEmbed(discord.Embed):
             description += f'`{word}`\n'
         super().__init__(title=title, description=description)
 
+def group_by_author(records):
+    '''
+    Groups records into a map from author ID to that author's records, in order of first appearance
+    '''
+    records_by_author = {}
+    for record in records:
+        records_by_author.setdefault(record.author_id, []).append(record)
+    return records_by_author
+
+def paginate(lines, limit=EMBED_DESCRIPTION_LIMIT):
+    '''
+    Joins lines into as few pages as possible without splitting a line or exceeding the limit
+    '''
+    pages = []
+    page = []
+    size = 0
+    for line in lines:
+        line = line[:limit]
+        if page and size + len(line) > limit:
+            pages.append(''.join(page))
+            page = []
+            size = 0
+        page.append(line)
+        size += len(line)
+    pages.append(''.join(page))
+    return pages
+
+def add_page_buttons(view, embed):
+    '''
+    Adds previous/next page buttons to a view if its embed has more than one page
+    '''
+    if len(embed.pages) < 2:
+        return
+    embed.show_page(0)
+
+    async def turn_page(interaction, step):
+        embed.show_page(embed.page + step)
+        await interaction.response.edit_message(embed=embed, view=view)
+
+    previous_button = discord.ui.Button(label='Previous page', style=discord.ButtonStyle.gray, row=1)
+    previous_button.callback = lambda interaction: turn_page(interaction, -1)
+    next_button = discord.ui.Button(label='Next page', style=discord.ButtonStyle.gray, row=1)
+    next_button.callback = lambda interaction: turn_page(interaction, 1)
+    view.add_item(previous_button)
+    view.add_item(next_button)
+
+def warning_message(channel):
+    return (
+        f"This is a warning from the moderators of `{channel.name}`.\n"
+        f"We've flagged your messages as abusive content.\n"
+        "Please refrain from using abusive language in the channel.")
+
+async def resolve_user(client, user_id):
+    '''
+    Look up a user by ID from the client cache, falling back to the API if they aren't cached
+    '''
+    return client.get_user(user_id) or await client.fetch_user(user_id)
+
+async def resolve_channel(client, channel_id):
+    '''
+    Look up a channel by ID from the client cache, falling back to the API if it isn't cached
+    '''
+    return client.get_channel(channel_id) or await client.fetch_channel(channel_id)
+
 def truncate_string(string, truncation_length=240):
     '''
     Truncate string to a certain length and add ellipsis if appropriate
@@ -1,38 +1,145 @@
-from message_processor import MessageProcessor
+'''
+Batch evaluation over a tweet corpus. Scores every row with Perspective under the configured rate limit, labels
+the abusive ones, and checks how often NER finds the targeted entity in them.
+
+    python eval.py ben_shapiro_tweets.csv --column tweet --qps 10
+
+Scores are appended to a checkpoint file as they arrive, so an interrupted run picks up where it left off.
+'''
+import argparse
+import asyncio
+import os
+import numpy as np
 import pandas as pd
-import time
-
-
-df = pd.read_csv('ben_shapiro_tweets.csv')
-
-mp = MessageProcessor()
-
-scores = []
-for i in range(500):
-    time.sleep(1)
-    scores.append(mp.eval_text(df['tweet'][i]))
-
-scores_df = pd.DataFrame(scores)
-scores_df.to_csv('tweet_scores.csv')
-
-scores_df = pd.read_csv('tweet_scores.csv')
-def func(row):
-    return row['SEXUALLY_EXPLICIT'] > 0.8 or row['SEVERE_TOXICITY'] > 0.8 or row['THREAT'] > 0.8 or row[
-        'TOXICITY'] > 0.8 or row['IDENTITY_ATTACK'] > 0.8
-
-scores_df['LABEL'] = scores_df.apply(lambda row: func(row), axis=1)
-
-count = 0
-c2 = 0
-for i in range(500):
-    if scores_df['LABEL'][i]:
-        init_entities = mp.eval_entities(df['tweet'][i])
-        entities = init_entities[0]
-        count += 1 if 'Ben Shapiro' in entities or '@benshapiro' in entities or 'ben shapiro' in entities or 'ben shapiro\'s' in entities else 0
-        if 'Ben Shapiro' in entities or '@benshapiro' in entities or 'ben shapiro' in entities or 'ben shapiro\'s' in entities:
-            pass
-        else:
-            print(init_entities)
-        c2 += 1
-print(count)
-print(c2)
+from message_processor import MessageProcessor, load_tokens, PERSPECTIVE_SCORE_THRESHOLD
+from ner_engine import load_ner_model, parse_batch
+from perspective_client import PerspectiveError, PERSPECTIVE_ATTRIBUTES
+
+EVAL_CONCURRENCY = 32
+EVAL_CHUNK_SIZE = 500
+EVAL_TARGETS = ['ben shapiro', '@benshapiro', "ben shapiro's"]
+
+
+def read_table(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def write_table(df, path):
+    if path.endswith('.parquet'):
+        df.to_parquet(path)
+    else:
+        df.to_csv(path)
+
+
+def load_checkpoint(path):
+    '''
+    Returns the scores saved by earlier runs, indexed by corpus row.
+    '''
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=PERSPECTIVE_ATTRIBUTES, dtype=float)
+    checkpoint = pd.read_csv(path, index_col=0)
+    return checkpoint[~checkpoint.index.duplicated(keep='last')]
+
+
+async def score_rows(mp, texts, checkpoint_path, concurrency, chunk_size):
+    '''
+    Scores the given rows with bounded concurrency, appending each finished chunk to the checkpoint. Rows that
+    fail are left out so the next run retries them. Blank rows, which Perspective rejects, are scored as zero
+    without a request. Returns the number of failed rows.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = 0
+
+    async def score(text):
+        if not text.strip():
+            return {attr: 0.0 for attr in PERSPECTIVE_ATTRIBUTES}
+        async with semaphore:
+            try:
+                return await mp.eval_text(text)
+            except PerspectiveError as err:
+                print(f'Perspective scoring failed: {err}')
+                return None
+
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts.iloc[start:start + chunk_size]
+        scores = await asyncio.gather(*(score(text) for text in chunk))
+        scored = [(i, row) for i, row in zip(chunk.index, scores) if row is not None]
+        failed += len(chunk) - len(scored)
+        if scored:
+            chunk_df = pd.DataFrame([row for _, row in scored], index=[i for i, _ in scored], columns=PERSPECTIVE_ATTRIBUTES)
+            chunk_df.to_csv(checkpoint_path, mode='a', header=not os.path.isfile(checkpoint_path))
+        print(f'Scored {min(start + chunk_size, len(texts))}/{len(texts)} rows ({failed} failed)')
+    return failed
+
+
+def entity_hits(texts, targets):
+    '''
+    Runs NER over the texts in one `nlp.pipe` pass and returns, per row, whether any entity matches a target,
+    along with how often each entity was found.
+    '''
+    if len(texts) == 0:
+        return pd.Series(False, index=texts.index), pd.Series(dtype=int)
+    parsed = parse_batch(list(texts), model=load_ner_model())
+    entities = pd.Series([sorted(entity_set) for entity_set, _ in parsed], index=texts.index).explode().dropna()
+    hits = entities.str.lower().isin(targets).groupby(level=0).any()
+    return hits.reindex(texts.index, fill_value=False), entities.value_counts()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score a tweet corpus with Perspective and check entity detection')
+    parser.add_argument('input', help='CSV or Parquet corpus')
+    parser.add_argument('--column', default='tweet', help='column holding the message text')
+    parser.add_argument('--output', default='tweet_scores.csv', help='scores and labels, as CSV or Parquet')
+    parser.add_argument('--checkpoint', help='defaults to <output>.checkpoint.csv')
+    parser.add_argument('--limit', type=int, help='only evaluate the first N rows')
+    parser.add_argument('--qps', type=float, help='Perspective QPS, overriding tokens.json')
+    parser.add_argument('--concurrency', type=int, default=EVAL_CONCURRENCY)
+    parser.add_argument('--chunk-size', type=int, default=EVAL_CHUNK_SIZE)
+    parser.add_argument('--threshold', type=float, default=PERSPECTIVE_SCORE_THRESHOLD)
+    parser.add_argument('--target', action='append', help='lowercased entity name counted as a hit (repeatable)')
+    args = parser.parse_args()
+    checkpoint_path = args.checkpoint or args.output + '.checkpoint.csv'
+    targets = args.target or EVAL_TARGETS
+
+    df = read_table(args.input)
+    if args.limit is not None:
+        df = df.iloc[:args.limit]
+    texts = df[args.column].fillna('').astype(str)
+
+    checkpoint = load_checkpoint(checkpoint_path)
+    remaining = texts[~texts.index.isin(checkpoint.index)]
+    print(f'{len(texts) - len(remaining)} rows already scored, {len(remaining)} to go')
+    if len(remaining) > 0:
+        tokens = load_tokens()
+        if args.qps is not None:
+            tokens['perspective_qps'] = args.qps
+        mp = MessageProcessor(tokens)
+
+        async def run():
+            try:
+                return await score_rows(mp, remaining, checkpoint_path, args.concurrency, args.chunk_size)
+            finally:
+                await mp.close()
+
+        failed = asyncio.run(run())
+        if failed:
+            print(f'{failed} rows failed to score; run again to retry them')
+        checkpoint = load_checkpoint(checkpoint_path)
+
+    scores_df = checkpoint.reindex(texts.index)
+    scores_df['LABEL'] = (scores_df[PERSPECTIVE_ATTRIBUTES].to_numpy() > args.threshold).any(axis=1)
+    labelled = texts[scores_df['LABEL']]
+    hits, entity_counts = entity_hits(labelled, set(targets))
+    scores_df['TARGET_HIT'] = hits.reindex(texts.index, fill_value=False)
+    write_table(scores_df, args.output)
+
+    print(f'{int(scores_df["LABEL"].sum())} of {len(texts)} rows labelled abusive')
+    print(f'{int(hits.sum())} of {len(labelled)} abusive rows mention a target ({np.mean(hits) if len(hits) else 0:.1%})')
+    print('Most common entities in abusive rows:')
+    print(entity_counts.head(20).to_string())
+
+
+if __name__ == '__main__':
+    main()
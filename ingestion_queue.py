@@ -0,0 +1,133 @@
+import asyncio
+import collections
+import logging
+import time
+
+logger = logging.getLogger('discord')
+
+INGESTION_QUEUE_SIZE = 1000
+INGESTION_CONSUMERS = 16
+INGESTION_LAG_WARNING = 30
+LAG_WARNING_INTERVAL = 60
+
+
+class QueuedMessage:
+    __slots__ = ('message', 'args', 'enqueued_at', 'benign', 'flagged')
+
+    def __init__(self, message, args, benign, flagged):
+        self.message = message
+        self.args = args
+        self.enqueued_at = time.monotonic()
+        self.benign = benign
+        self.flagged = flagged
+
+
+class IngestionQueue:
+    '''
+    Bounded queue between the gateway and the detection pipeline, drained by a fixed number of consumer tasks.
+    When the queue is full, benign-looking messages are shed first: a new benign message is dropped, otherwise the
+    oldest queued benign message is evicted to make room. Messages containing flagged keywords are always kept,
+    even past capacity. `classify` returns (benign, flagged) for a message. A paused queue keeps accepting
+    messages, under the same capacity rules, but holds them until it is resumed.
+    '''
+    def __init__(self, handler, classify, capacity=INGESTION_QUEUE_SIZE, consumers=INGESTION_CONSUMERS):
+        self.handler = handler
+        self.classify = classify
+        self.capacity = capacity
+        self.num_consumers = consumers
+        self.queue = collections.deque()
+        self.available = None
+        self.paused = False
+        self.running = None
+        self.consumers = []
+        self.last_lag = 0
+        self.last_lag_warning = 0
+        self.stats = {'enqueued': 0, 'processed': 0, 'dropped': 0, 'evicted': 0, 'over_capacity': 0, 'failed': 0}
+
+    def ensure_consumers(self):
+        if self.available is None:
+            self.available = asyncio.Semaphore(0)
+            self.running = asyncio.Event()
+            if not self.paused:
+                self.running.set()
+        self.consumers = [task for task in self.consumers if not task.done()]
+        while len(self.consumers) < self.num_consumers:
+            self.consumers.append(asyncio.ensure_future(self.consume()))
+
+    def put(self, message, *args):
+        '''
+        Enqueues a message, plus any extra arguments for the handler, without waiting. Returns False if the message
+        was shed.
+        '''
+        self.ensure_consumers()
+        benign, flagged = self.classify(message)
+        if len(self.queue) >= self.capacity:
+            if benign and not flagged:
+                self.stats['dropped'] += 1
+                return False
+            if not self.evict_benign():
+                if not flagged:
+                    self.stats['dropped'] += 1
+                    return False
+                self.stats['over_capacity'] += 1
+        self.queue.append(QueuedMessage(message, args, benign, flagged))
+        self.stats['enqueued'] += 1
+        self.available.release()
+        return True
+
+    def pause(self):
+        self.paused = True
+        if self.running is not None:
+            self.running.clear()
+
+    def resume(self):
+        self.paused = False
+        if self.running is not None:
+            self.running.set()
+
+    def evict_benign(self):
+        for entry in self.queue:
+            if entry.benign and not entry.flagged:
+                self.queue.remove(entry)
+                self.stats['evicted'] += 1
+                return True
+        return False
+
+    async def consume(self):
+        while True:
+            await self.running.wait()
+            await self.available.acquire()
+            if not self.queue:
+                # The entry this permit was released for has since been evicted
+                continue
+            entry = self.queue.popleft()
+            self.record_lag(time.monotonic() - entry.enqueued_at)
+            try:
+                await self.handler(entry.message, *entry.args)
+            except Exception:
+                self.stats['failed'] += 1
+                logger.exception('Detection pipeline failed on a queued message')
+            self.stats['processed'] += 1
+
+    def record_lag(self, lag):
+        self.last_lag = lag
+        now = time.monotonic()
+        if lag > INGESTION_LAG_WARNING and now - self.last_lag_warning > LAG_WARNING_INTERVAL:
+            self.last_lag_warning = now
+            logger.warning(f'Detection is {lag:.1f}s behind with {len(self.queue)} messages queued')
+
+    def depth(self):
+        return len(self.queue)
+
+    def lag(self):
+        '''
+        Returns how long the oldest queued message has been waiting, in seconds.
+        '''
+        if not self.queue:
+            return 0
+        return time.monotonic() - self.queue[0].enqueued_at
+
+    async def close(self):
+        for task in self.consumers:
+            task.cancel()
+        self.consumers = []
@@ -0,0 +1,25 @@
+class KeywordMatcher:
+    '''
+    Matches a tokenized message against the moderator-flagged keywords. The keywords are kept in a hash set that
+    is extended in place as keywords get flagged, and matching walks the message's distinct tokens once, so the
+    per-message cost depends only on the message length and not on how many keywords have been flagged.
+    '''
+    def __init__(self, keywords=()):
+        self.keywords = set(keywords)
+
+    def add(self, keywords):
+        self.keywords.update(keyword.lower() for keyword in keywords)
+
+    def match(self, tokenized_message):
+        '''
+        Returns every flagged keyword that appears in the tokenized message, each listed once.
+        '''
+        if not self.keywords:
+            return []
+        return [token for token in set(tokenized_message) if token in self.keywords]
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def __iter__(self):
+        return iter(self.keywords)
@@ -3,6 +3,8 @@ import discord
 from discord.ext import commands
 from discord.ui import Button, View
 import re
+from profiler import watch_latency
+from bulk_delete import interaction_progress
 
 
 
@@ -155,11 +157,11 @@ class ManualReview:
     async def take_action_on_harassment(self):
         view = None
         if self.target_twitter_info and len(self.targeted_harassment_messages) > 0:
-            view = TargetedHarassmentTwitterView(self.targeted_harassment_messages, self.target_twitter_info, self.mod_channel, self.reporting_channel, self.kicked_users)
+            view = TargetedHarassmentTwitterView(self.targeted_harassment_messages, self.target_twitter_info, self.mod_channel, self.reporting_channel, self.kicked_users, self.client.bulk_deleter)
         elif self.target_twitter_info:
             view = TwitterView(self.target_twitter_info, self.mod_channel)
         elif len(self.targeted_harassment_messages) > 0:
-            view = TargetedHarassmentView(self.targeted_harassment_messages, self.reporting_channel, self.kicked_users)
+            view = TargetedHarassmentView(self.targeted_harassment_messages, self.reporting_channel, self.kicked_users, self.client.bulk_deleter)
         else:
             await self.mod_channel.send("No actions to take on harassment campaign; no reported messages or Twitter account.")
             return
@@ -231,12 +233,30 @@ def truncate_string(string):
     return string[:TRUNCATION_LENGTH] + ("..." if len(string) > TRUNCATION_LENGTH else "")
 
 
+async def notify_deleted_messages(reporting_channel, messages, report):
+    '''
+    Tells the reporter which of their reported messages were deleted, in as few messages as fit Discord's limit
+    '''
+    notice = ''
+    for message in messages:
+        if message.id not in report.deleted:
+            continue
+        line = f"The message you reported was deleted [`{message.author} said: \"{truncate_string(message.content)}\"`].\n"
+        if len(notice) + len(line) > 2000:
+            await reporting_channel.send(notice)
+            notice = ''
+        notice += line
+    if notice:
+        await reporting_channel.send(notice)
+
+
 class InitialMessageView(View):
     def __init__(self, begin_review):
         super().__init__()
         self.begin_review = begin_review
 
     @discord.ui.button(label='Review Reported Message', style=discord.ButtonStyle.green)
+    @watch_latency
     async def begin_review_callback(self, button, interaction):
         button.label = 'Started Message Review'
         button.disabled = True
@@ -251,6 +271,7 @@ class InitialMessageViewHarassment(View):
         self.take_action_on_harassment = take_action_on_harassment
 
     @discord.ui.button(label='Review Reported Message', style=discord.ButtonStyle.green)
+    @watch_latency
     async def begin_review_callback(self, button, interaction):
         button.label = 'Started Review'
         button.disabled = True
@@ -258,6 +279,7 @@ class InitialMessageViewHarassment(View):
         await self.begin_review()
 
     @discord.ui.button(label='Review Harassment Campaign', style=discord.ButtonStyle.blurple)
+    @watch_latency
     async def review_harassment_callback(self, button, interaction):
         button.label = 'Started Harassment Review'
         button.disabled = True
@@ -274,6 +296,7 @@ class InitialMessageViewDanger(View):
         self.begin_review = begin_review
 
     @discord.ui.button(label='Review Reported Message', style=discord.ButtonStyle.green)
+    @watch_latency
     async def begin_review_callback(self, button, interaction):
         button.label = 'Started Review'
         button.disabled = True
@@ -281,6 +304,7 @@ class InitialMessageViewDanger(View):
         await self.begin_review()
 
     @discord.ui.button(label='Report to Authorities', style=discord.ButtonStyle.red)
+    @watch_latency
     async def report_authorities_callback(self, button, interaction):
         button.label = 'Authorities Alerted'
         button.disabled = True
@@ -302,6 +326,7 @@ class InitialMessageViewDangerHarassment(View):
         self.take_action_on_harassment = take_action_on_harassment
 
     @discord.ui.button(label='Review Reported Message', style=discord.ButtonStyle.green)
+    @watch_latency
     async def begin_review_callback(self, button, interaction):
         button.label = 'Started Review'
         button.disabled = True
@@ -309,6 +334,7 @@ class InitialMessageViewDangerHarassment(View):
         await self.begin_review()
 
     @discord.ui.button(label='Review Harassment Campaign', style=discord.ButtonStyle.blurple)
+    @watch_latency
     async def review_harassment_callback(self, button, interaction):
         button.label = 'Started Harassment Review'
         button.disabled = True
@@ -316,6 +342,7 @@ class InitialMessageViewDangerHarassment(View):
         await self.take_action_on_harassment()
 
     @discord.ui.button(label='Report to Authorities', style=discord.ButtonStyle.red)
+    @watch_latency
     async def report_authorities_callback(self, button, interaction):
         button.label = 'Authorities Alerted'
         button.disabled = True
@@ -334,6 +361,7 @@ class EvaluateAbuseView(View):
         self.take_action_on_message = take_action_on_message
 
     @discord.ui.button(label='No', style=discord.ButtonStyle.red)
+    @watch_latency
     async def no_callback(self, button, interaction):
         for child in self.children:
             child.disabled = True
@@ -341,6 +369,7 @@ class EvaluateAbuseView(View):
         await self.return_to_user()
 
     @discord.ui.button(label='Yes', style=discord.ButtonStyle.green)
+    @watch_latency
     async def yes_callback(self, button, interaction):
         for child in self.children:
             child.disabled = True
@@ -355,6 +384,7 @@ class ReturnUserView(View):
         self.reporting_channel = reporting_channel
 
     @discord.ui.button(label="Don't send", style=discord.ButtonStyle.red)
+    @watch_latency
     async def cancel_callback(self, button, interaction):
         button.label = "Not sent"
         for child in self.children:
@@ -362,6 +392,7 @@ class ReturnUserView(View):
         await interaction.response.edit_message(view=self)
 
     @discord.ui.button(label='Send', style=discord.ButtonStyle.green)
+    @watch_latency
     async def send_callback(self, button, interaction):
         button.label = 'Sent'
         for child in self.children:
@@ -379,6 +410,7 @@ class TakeActionView(View):
         self.kicked_users = kicked_users
 
     @discord.ui.button(label='Delete message', style=discord.ButtonStyle.gray)
+    @watch_latency
     async def delete_message_callback(self, button, interaction):
         button.label = 'Message deleted'
         button.disabled = True
@@ -390,6 +422,7 @@ class TakeActionView(View):
             await self.mod_channel.send("Looks like that message was already deleted.")
 
     @discord.ui.button(label='Kick user', style=discord.ButtonStyle.red)
+    @watch_latency
     async def kick_user_callback(self, button, interaction):
         button.label = 'User kicked'
         button.disabled = True
@@ -401,26 +434,27 @@ class TakeActionView(View):
 
 
 class TargetedHarassmentView(View):
-    def __init__(self, targeted_harassment_messages, reporting_channel, kicked_users):
+    def __init__(self, targeted_harassment_messages, reporting_channel, kicked_users, bulk_deleter):
         super().__init__()
         self.targeted_harassment_messages = targeted_harassment_messages
         self.reporting_channel = reporting_channel
         self.kicked_users = kicked_users
+        self.bulk_deleter = bulk_deleter
 
     @discord.ui.button(label='Delete all messages', style=discord.ButtonStyle.gray)
+    @watch_latency
     async def delete_message_callback(self, button, interaction):
         await interaction.response.defer()
-        button.label = 'Messages deleted'
+        button.label = 'Deleting messages...'
         button.disabled = True
-        for message in self.targeted_harassment_messages:
-            try:
-                await message.delete()
-                await self.reporting_channel.send(f"The message you reported was deleted [`{message.author} said: \"{truncate_string(message.content)}\"`].")
-            except discord.errors.NotFound as err:
-                pass
         await interaction.edit_original_message(view=self)
+        report = await self.bulk_deleter.delete(self.targeted_harassment_messages, progress=interaction_progress(interaction))
+        await notify_deleted_messages(self.reporting_channel, self.targeted_harassment_messages, report)
+        button.label = 'Messages deleted'
+        await interaction.edit_original_message(content=report.summary(), view=self)
 
     @discord.ui.button(label='Kick users', style=discord.ButtonStyle.red)
+    @watch_latency
     async def kick_user_callback(self, button, interaction):
         await interaction.response.defer()
         button.label = 'Users kicked'
@@ -439,6 +473,7 @@ class TwitterView(View):
         self.mod_channel = mod_channel
 
     @discord.ui.button(label='Share Harassment with Twitter', style=discord.ButtonStyle.blurple)
+    @watch_latency
     async def report_twitter_callback(self, button, interaction):
         button.label = 'Sent to Twitter'
         button.disabled = True
@@ -452,28 +487,29 @@ class TwitterView(View):
 
 
 class TargetedHarassmentTwitterView(View):
-    def __init__(self, targeted_harassment_messages, target_twitter_info, mod_channel, reporting_channel, kicked_users):
+    def __init__(self, targeted_harassment_messages, target_twitter_info, mod_channel, reporting_channel, kicked_users, bulk_deleter):
         super().__init__()
         self.targeted_harassment_messages = targeted_harassment_messages
         self.target_twitter_info = target_twitter_info
         self.mod_channel = mod_channel
         self.reporting_channel = reporting_channel
         self.kicked_users = kicked_users
+        self.bulk_deleter = bulk_deleter
 
     @discord.ui.button(label='Delete all messages', style=discord.ButtonStyle.gray)
+    @watch_latency
     async def delete_message_callback(self, button, interaction):
         await interaction.response.defer()
-        button.label = 'Messages deleted'
+        button.label = 'Deleting messages...'
         button.disabled = True
-        for message in self.targeted_harassment_messages:
-            try:
-                await message.delete()
-                await self.reporting_channel.send(f"The message you reported was deleted [`{message.author} said: \"{truncate_string(message.content)}\"`].")
-            except discord.errors.NotFound as err:
-                pass
         await interaction.edit_original_message(view=self)
+        report = await self.bulk_deleter.delete(self.targeted_harassment_messages, progress=interaction_progress(interaction))
+        await notify_deleted_messages(self.reporting_channel, self.targeted_harassment_messages, report)
+        button.label = 'Messages deleted'
+        await interaction.edit_original_message(content=report.summary(), view=self)
 
     @discord.ui.button(label='Kick users', style=discord.ButtonStyle.red)
+    @watch_latency
     async def kick_user_callback(self, button, interaction):
         await interaction.response.defer()
         button.label = 'Users kicked'
@@ -486,6 +522,7 @@ class TargetedHarassmentTwitterView(View):
         await interaction.edit_original_message(view=self)
 
     @discord.ui.button(label='Share Harassment with Twitter', style=discord.ButtonStyle.blurple)
+    @watch_latency
     async def report_twitter_callback(self, button, interaction):
         button.label = 'Sent to Twitter'
         button.disabled = True
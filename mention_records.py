@@ -0,0 +1,165 @@
+import collections
+from array import array
+from datetime import datetime, timezone
+
+MENTION_CONTENT_LENGTH = 240
+USER_MESSAGE_CAP = 50
+ENTITY_MENTION_CAP = 200
+FINGERPRINT_CAP = 20000
+
+
+class TokenVocabulary:
+    '''
+    Interns token strings to small integer IDs so that stored messages hold compact ID arrays rather than lists
+    of strings.
+    '''
+    def __init__(self):
+        self.ids = {}
+        self.tokens = []
+
+    def intern(self, token):
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+        return token_id
+
+    def intern_all(self, tokens):
+        return array('I', (self.intern(token) for token in tokens))
+
+    def token(self, token_id):
+        return self.tokens[token_id]
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+class IncomingMessage:
+    '''
+    Picklable snapshot of a discord.Message with just what detection needs, so messages can be handed to the
+    processor worker processes.
+    '''
+    __slots__ = ('message_id', 'channel_id', 'guild_id', 'author_id', 'created_at', 'content')
+
+    def __init__(self, message_id, channel_id, guild_id, author_id, created_at, content):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.created_at = created_at
+        self.content = content
+
+    @classmethod
+    def from_message(cls, message):
+        return cls(
+            message_id=message.id,
+            channel_id=message.channel.id,
+            guild_id=message.guild.id,
+            author_id=message.author.id,
+            created_at=message.created_at.timestamp(),
+            content=message.content)
+
+
+class MentionRecord:
+    '''
+    Compact stand-in for a flagged discord.Message. Only IDs, the creation time, truncated content and interned
+    token IDs are kept; jump URLs and partial messages are rebuilt from the IDs when a moderator acts on them.
+    '''
+    __slots__ = ('message_id', 'channel_id', 'guild_id', 'author_id', 'created_at', 'content', 'token_ids')
+
+    def __init__(self, message_id, channel_id, guild_id, author_id, created_at, content, token_ids=()):
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.created_at = created_at
+        self.content = content
+        self.token_ids = token_ids
+
+    @classmethod
+    def from_incoming(cls, message, token_ids=()):
+        content = message.content
+        if len(content) > MENTION_CONTENT_LENGTH:
+            content = content[:MENTION_CONTENT_LENGTH] + "..."
+        return cls(
+            message_id=message.message_id,
+            channel_id=message.channel_id,
+            guild_id=message.guild_id,
+            author_id=message.author_id,
+            created_at=message.created_at,
+            content=content,
+            token_ids=token_ids)
+
+    @property
+    def created_datetime(self):
+        return datetime.fromtimestamp(self.created_at, timezone.utc)
+
+    @property
+    def jump_url(self):
+        return f'https://discord.com/channels/{self.guild_id}/{self.channel_id}/{self.message_id}'
+
+    def partial_message(self, client):
+        '''
+        Returns a discord.PartialMessage for this record, or None if the channel is no longer visible.
+        '''
+        channel = client.get_channel(self.channel_id)
+        if channel is None:
+            return None
+        return channel.get_partial_message(self.message_id)
+
+
+class MessageFingerprint:
+    '''
+    What a processed message contributed to the detection state: its content hash, its token IDs in the ledger,
+    the entities credited with it, and its MentionRecord if it was counted as abusive. Used to apply edits.
+    '''
+    __slots__ = ('digest', 'token_ids', 'entities', 'record')
+
+    def __init__(self, digest, token_ids, entities, record):
+        self.digest = digest
+        self.token_ids = token_ids
+        self.entities = entities
+        self.record = record
+
+
+class RingBufferMap:
+    '''
+    Map from key to a ring buffer holding at most `cap` of the most recent items appended under that key.
+    '''
+    def __init__(self, cap):
+        self.cap = cap
+        self.buffers = {}
+
+    def append(self, key, item):
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = collections.deque(maxlen=self.cap)
+        buffer.append(item)
+
+    def remove(self, key, item):
+        '''
+        Removes the item from the key's buffer if it is still there, dropping the buffer once empty.
+        '''
+        buffer = self.buffers.get(key)
+        if buffer is None or item not in buffer:
+            return
+        buffer.remove(item)
+        if not buffer:
+            del self.buffers[key]
+
+    def get(self, key, default=None):
+        buffer = self.buffers.get(key)
+        return list(buffer) if buffer is not None else default
+
+    def __getitem__(self, key):
+        return list(self.buffers[key])
+
+    def __contains__(self, key):
+        return key in self.buffers
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def items(self):
+        return ((key, list(buffer)) for key, buffer in self.buffers.items())
@@ -0,0 +1,51 @@
+import collections
+from metrics import REGISTRY
+
+MESSAGE_CACHE_SIZE = 10000
+
+
+class MessageCache:
+    '''
+    Bounded LRU map from message ID to the discord.Message objects the bot received over the gateway, so report
+    links can be resolved without a REST fetch. Entries are dropped when the message is edited or deleted, and
+    misses fall back to fetching the message from its channel.
+    '''
+    def __init__(self, max_messages=MESSAGE_CACHE_SIZE):
+        self.max_messages = max_messages
+        self.messages = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def add(self, message):
+        self.messages[message.id] = message
+        self.messages.move_to_end(message.id)
+        while len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+
+    def invalidate(self, message_id):
+        if self.messages.pop(message_id, None) is not None:
+            self.stats['invalidations'] += 1
+
+    def get(self, message_id):
+        message = self.messages.get(message_id)
+        if message is not None:
+            self.messages.move_to_end(message_id)
+        return message
+
+    async def resolve(self, channel, message_id):
+        '''
+        Returns the message with the given ID in the channel, from the cache if possible. Raises
+        discord.errors.NotFound like `channel.fetch_message` if it doesn't exist.
+        '''
+        message = self.get(message_id)
+        if message is not None and message.channel.id == channel.id:
+            self.stats['hits'] += 1
+            REGISTRY.inc('message_cache_hits')
+            return message
+        self.stats['misses'] += 1
+        REGISTRY.inc('message_cache_misses')
+        message = await channel.fetch_message(message_id)
+        self.add(message)
+        return message
+
+    def __len__(self):
+        return len(self.messages)
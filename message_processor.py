@@ -1,121 +1,381 @@
-import requests
-import spacy
+import asyncio
+import collections
+import contextlib
 import json
-import math
+import logging
+import os
+import sys
+import time
 from uni2ascii import uni2ascii
+from perspective_client import PerspectiveClient, PerspectiveError, PERSPECTIVE_ATTRIBUTES, PERSPECTIVE_URL
+from perspective_scheduler import PerspectiveScheduler, SharedTokenBucket, PERSPECTIVE_QPS
+from score_cache import ScoreCache, SCORE_CACHE_PATH, SCORE_CACHE_DISK_SIZE, fingerprint
+from ner_engine import NEREngine
+from prefilter import CascadeFilter, PREFILTER_RECALL_TARGET
+from keyword_matcher import KeywordMatcher
+from mention_records import MentionRecord, MessageFingerprint, RingBufferMap, USER_MESSAGE_CAP, ENTITY_MENTION_CAP, FINGERPRINT_CAP
+from tf_idf_engine import TfIdfEngine
+from windowed_scores import SlidingWindowScores
+from state_store import StateStore, STATE_DIR
+from metrics import REGISTRY
+
+logger = logging.getLogger('discord')
 
 PERSPECTIVE_SCORE_THRESHOLD = 0.8
 ABUSIVE_MESSAGE_COUNT_THRESHOLD = 5
 ENTITY_SCORE_THRESHOLD = 12
 TF_IDF_SURFACING_THRESHOLD = 0.075
+USER_ABUSE_WINDOW = 6 * 60 * 60
+ENTITY_SCORE_WINDOW = 24 * 60 * 60
 
-class MessageProcessor:
+def load_tokens():
+    with open('tokens.json') as f:
+        return json.load(f)
+
+
+class MessageLocks:
+    '''
+    One asyncio lock per message ID, dropped again once nothing holds or waits on it.
+    '''
     def __init__(self):
-        with open('tokens.json') as f:
-            self.perspective_key = json.load(f)['perspective']
-        self.named_entity_model = spacy.load('en_core_web_sm')
-        self.user_to_abusive_messages = {}
-        self.user_abuse_count = {}
-        self.num_total_messages = 0
-        self.token_document_frequency = {}
-        self.abused_entity_scores = {}
-        self.entity_mentions = {}
-        self.flagged_tokens = set()
+        self.locks = {} # Map from message ID to [lock, number of holders and waiters]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, message_id):
+        entry = self.locks.get(message_id)
+        if entry is None:
+            entry = self.locks[message_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[message_id]
+
+
+class ScoringServices:
+    '''
+    The Perspective scheduler, score cache and NER engine. These are shared by every MessageProcessor in a process
+    so that guild shards draw on one quota, one cache and one model. Processes that pass the same `rate_state`
+    share one Perspective rate limit.
+    '''
+    def __init__(self, tokens, ner_in_process=False, rate_state=None):
+        qps = tokens.get('perspective_qps', PERSPECTIVE_QPS)
+        self.perspective_scheduler = PerspectiveScheduler(
+            PerspectiveClient(tokens['perspective'], url=tokens.get('perspective_url', PERSPECTIVE_URL)),
+            qps=qps,
+            bucket=SharedTokenBucket(qps, rate_state) if rate_state is not None else None)
+        self.score_cache = ScoreCache(
+            path=tokens.get('score_cache_path', SCORE_CACHE_PATH),
+            max_disk_entries=tokens.get('score_cache_disk_size', SCORE_CACHE_DISK_SIZE))
+        self.ner_engine = NEREngine(in_process=ner_in_process)
+        REGISTRY.gauge_callback('perspective_queue_depth', self.perspective_scheduler.queue_depth)
+        REGISTRY.gauge_callback('score_cache', self.score_cache_stats)
+
+    async def warm_up(self):
+        await self.ner_engine.warm_up()
+        # Open the pooled Perspective session up front, without spending quota on a request
+        self.perspective_scheduler.client.get_session()
+
+    def score_cache_stats(self):
+        return dict(self.score_cache.stats, hit_rate=self.score_cache.hit_rate(), entries=len(self.score_cache.entries))
+
+    async def close(self):
+        await self.perspective_scheduler.close()
+        self.score_cache.close()
+        self.ner_engine.close()
+
+
+class MessageProcessor:
+    def __init__(self, tokens=None, guild_id=None, services=None):
+        '''
+        Detection state for one guild. Standalone processors (guild_id None) build their own scoring services and
+        keep no durable state; guild shards share their worker's services and persist under `state_dir`.
+        '''
+        if tokens is None:
+            tokens = load_tokens()
+        self.perspective_key = tokens['perspective']
+        prefilter_recall_target = tokens.get('prefilter_recall_target', PREFILTER_RECALL_TARGET)
+        user_message_cap = tokens.get('user_message_cap', USER_MESSAGE_CAP)
+        entity_mention_cap = tokens.get('entity_mention_cap', ENTITY_MENTION_CAP)
+        user_abuse_window = tokens.get('user_abuse_window', USER_ABUSE_WINDOW)
+        entity_score_window = tokens.get('entity_score_window', ENTITY_SCORE_WINDOW)
+        state_dir = tokens.get('state_dir', STATE_DIR)
+        self.guild_id = guild_id
+        self.owns_services = services is None
+        self.services = services if services is not None else ScoringServices(tokens)
+        self.perspective_scheduler = self.services.perspective_scheduler
+        self.score_cache = self.services.score_cache
+        self.ner_engine = self.services.ner_engine
+        self.prefilter = CascadeFilter(recall_target=prefilter_recall_target)
+        self.tf_idf = TfIdfEngine()
+        self.user_to_abusive_messages = RingBufferMap(user_message_cap) # Map from author ID to recent MentionRecords
+        self.user_abuse_count = SlidingWindowScores(user_abuse_window)
+        self.abused_entity_scores = SlidingWindowScores(entity_score_window)
+        # Keys updated since the last threshold check, in update order. Windowed scores only fall on their own,
+        # so these are the only keys that can have newly crossed a threshold.
+        self.dirty_users = {}
+        self.dirty_entities = {}
+        self.entity_mentions = RingBufferMap(entity_mention_cap)
+        self.flagged_tokens = KeywordMatcher()
+        self.message_fingerprints = collections.OrderedDict() # Map from message ID to its MessageFingerprint
+        self.message_locks = MessageLocks()
+        self.state_store = None
+        if state_dir is not None and guild_id is not None:
+            state_dir = os.path.join(state_dir, str(guild_id))
+            self.state_store = StateStore(state_dir)
+            replayed = self.state_store.restore(self)
+            logger.info(f'Restored detection state from {state_dir} ({replayed} journal events replayed)')
 
     # public method
-    def process_message(self, message):
-        user = message.author
-        message_content = uni2ascii(message.content)
-        perspective_scores = self.eval_text(message_content)
-        entity_set, tokenized_message = self.eval_entities(message_content)
-        self.update_message_ledger(tokenized_message)
-        if (any(score >= PERSPECTIVE_SCORE_THRESHOLD for score in perspective_scores.values()) or
-            any(token in tokenized_message for token in self.flagged_tokens)):
-            self.update_targeted_entities(entity_set, perspective_scores, message, tokenized_message)
-            self.user_to_abusive_messages[user] = self.user_to_abusive_messages.get(user, []) + [message]
-            self.user_abuse_count[user] = self.user_abuse_count.get(user, 0) + 1
+    async def process_message(self, message, edited=False):
+        '''
+        Evaluates an IncomingMessage and folds it into the detection state. For an edit of a message seen before,
+        nothing is done if the content is unchanged, and otherwise the edit replaces the original's contribution.
+        '''
+        # The worker handles requests concurrently, so an edit can arrive while its original is still being scored.
+        # Versions of one message are processed one at a time, in arrival order, so the edit sees the original.
+        async with self.message_locks.hold(message.message_id):
+            await self.evaluate_message(message, edited)
+
+    async def evaluate_message(self, message, edited):
+        digest = fingerprint(message.content)
+        previous = self.message_fingerprints.get(message.message_id)
+        if previous is not None and not edited:
+            # Already counted, either redelivered or overtaken by one of its own edits
+            REGISTRY.inc('duplicate_messages_skipped')
+            return
+        if previous is not None and previous.digest == digest:
+            REGISTRY.inc('unchanged_edits_skipped')
+            return
+        start = time.perf_counter()
+        with REGISTRY.timer('uni2ascii'):
+            message_content = uni2ascii(message.content)
+        with REGISTRY.timer('ner'):
+            entity_set, tokenized_message = await self.eval_entities(message_content)
+        flagged_token_matches = self.flagged_tokens.match(tokenized_message)
+        contains_flagged_tokens = len(flagged_token_matches) > 0
+        perspective_scores = {attr: 0 for attr in PERSPECTIVE_ATTRIBUTES}
+        # Only escalate to Perspective when the local pre-filter can't rule the message out
+        escalate, local_score, weight = self.prefilter.should_escalate(message_content, tokenized_message, contains_flagged_tokens)
+        if escalate:
+            try:
+                with REGISTRY.timer('perspective'):
+                    perspective_scores = await self.eval_text(message_content)
+                self.prefilter.observe(
+                    local_score,
+                    weight,
+                    any(score >= PERSPECTIVE_SCORE_THRESHOLD for score in perspective_scores.values()))
+            except PerspectiveError as err:
+                # Keep going on the flagged keywords alone rather than dropping the message
+                logger.warning(f'Perspective scoring failed: {err}')
+                REGISTRY.inc('perspective_failures')
+        with REGISTRY.timer('ledger_update'):
+            self.apply_message(
+                MentionRecord.from_incoming(message), digest, tokenized_message, entity_set, perspective_scores,
+                flagged_token_matches, previous=previous)
+        REGISTRY.observe('process_message', time.perf_counter() - start)
+        REGISTRY.inc('messages_processed')
+
+    def apply_message(self, record, digest, tokenized_message, entity_set, perspective_scores, flagged_token_matches, previous=None, journal=True):
+        '''
+        Folds an evaluated message into the detection state. This is the only place message state changes, so it
+        is also what the state store replays after a restart. `previous` is the fingerprint of the original when
+        the message is an edit.
+        '''
+        if previous is None:
+            record.token_ids = self.update_message_ledger(tokenized_message)
+        else:
+            record.token_ids = self.tf_idf.replace_document(previous.token_ids, tokenized_message)
+        is_abusive = (any(score >= PERSPECTIVE_SCORE_THRESHOLD for score in perspective_scores.values()) or
+            len(flagged_token_matches) > 0)
+        counted_record = None
+        credited_entities = frozenset()
+        if previous is not None and previous.record is not None:
+            counted_record = previous.record
+            credited_entities = previous.entities
+            if is_abusive:
+                # The original was already counted as abusive, so the author isn't counted again and only entities
+                # the edit introduces are credited. The counted record takes the edited text, since its old tokens
+                # have just left the document frequencies and keywords must come from what is in the channel.
+                counted_record.content = record.content
+                counted_record.token_ids = record.token_ids
+                new_entities = set(entity_set) - credited_entities
+                self.update_targeted_entities(new_entities, perspective_scores, counted_record, flagged_token_matches)
+                credited_entities = credited_entities | new_entities
+            else:
+                # The edit took the abuse out, so alerts and keywords must stop showing the message
+                self.retract_record(counted_record, credited_entities)
+                counted_record = None
+                credited_entities = frozenset()
+        elif is_abusive:
+            counted_record = record
+            credited_entities = frozenset(entity_set)
+            self.update_targeted_entities(entity_set, perspective_scores, record, flagged_token_matches)
+            self.user_to_abusive_messages.append(record.author_id, record)
+            self.user_abuse_count.add(record.author_id, 1, now=record.created_at)
+            self.dirty_users[record.author_id] = True
+        self.remember_fingerprint(
+            record.message_id,
+            MessageFingerprint(digest, record.token_ids, credited_entities, counted_record))
+        if journal:
+            payload = {
+                'digest': digest.hex(),
+                'edit': previous is not None,
+                'tokens': tokenized_message,
+                'record': [record.message_id, record.channel_id, record.guild_id, record.author_id,
+                           record.created_at, record.content],
+            }
+            if is_abusive:
+                payload.update({
+                    'entities': list(entity_set),
+                    'scores': perspective_scores,
+                    'flagged': flagged_token_matches,
+                })
+            self.journal('message', payload)
+
+    def retract_record(self, record, entities):
+        '''
+        Takes a counted abusive record back out of its author's and entities' buffers, and out of its author's
+        windowed count. Entity scores are left alone, since they aren't kept per message.
+        '''
+        for entity in entities:
+            self.entity_mentions.remove(entity, record)
+        self.user_to_abusive_messages.remove(record.author_id, record)
+        if self.user_abuse_count.score(record.author_id) >= 1:
+            self.user_abuse_count.add(record.author_id, -1, now=record.created_at)
+
+    def remember_fingerprint(self, message_id, message_fingerprint):
+        self.message_fingerprints[message_id] = message_fingerprint
+        self.message_fingerprints.move_to_end(message_id)
+        while len(self.message_fingerprints) > FINGERPRINT_CAP:
+            self.message_fingerprints.popitem(last=False)
 
     def user_abuse_threshold_exceeded(self):
+        start = time.perf_counter()
         users_exceeding_threshold = []
-        for user, messages in self.user_to_abusive_messages.items():
-            if self.user_abuse_count[user] >= ABUSIVE_MESSAGE_COUNT_THRESHOLD:
-                users_exceeding_threshold.append((user, messages))
-                self.user_abuse_count[user] = 0
+        now = time.time()
+        dirty_users, self.dirty_users = self.dirty_users, {}
+        for user in dirty_users:
+            if self.user_abuse_count.score(user, now) >= ABUSIVE_MESSAGE_COUNT_THRESHOLD:
+                users_exceeding_threshold.append((user, self.user_to_abusive_messages[user]))
+                self.user_abuse_count.reset(user)
+                self.journal('reset_user', user)
+        REGISTRY.observe('user_threshold_scan', time.perf_counter() - start)
         return users_exceeding_threshold
 
     def entity_abuse_threshold_exceeded(self):
+        start = time.perf_counter()
         entities_exceeding_threshold = []
-        for entity, harassment_score in self.abused_entity_scores.items():
-            if harassment_score >= ENTITY_SCORE_THRESHOLD:
+        now = time.time()
+        dirty_entities, self.dirty_entities = self.dirty_entities, {}
+        for entity in dirty_entities:
+            if self.abused_entity_scores.score(entity, now) >= ENTITY_SCORE_THRESHOLD:
                 mentions = self.entity_mentions[entity]
                 entities_exceeding_threshold.append((entity, mentions))
-                self.abused_entity_scores[entity] = 0
+                self.abused_entity_scores.reset(entity)
+                self.journal('reset_entity', entity)
+        REGISTRY.observe('entity_threshold_scan', time.perf_counter() - start)
         return entities_exceeding_threshold
 
     def update_flagged_tokens(self, tokens):
-        self.flagged_tokens.update(tokens)
+        self.flagged_tokens.add(tokens)
+        self.journal('flag', list(tokens))
 
-    # private methods
-    def eval_text(self, message):
-        '''
-        Given a message string, forwards the message to Perspective and returns a dictionary of scores.
-        '''
-        PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
-        url = PERSPECTIVE_URL + '?key=' + self.perspective_key
-        data_dict = {
-            'comment': {'text': message},
-            'languages': ['en'],
-            'requestedAttributes': {
-                                    'SEVERE_TOXICITY': {}, 'IDENTITY_ATTACK': {},
-                                    'THREAT': {}, 'TOXICITY': {}, 'SEXUALLY_EXPLICIT': {},
-                                },
-            'doNotStore': True
+    def journal(self, kind, payload):
+        if self.state_store is not None and self.state_store.append(kind, payload):
+            self.state_store.snapshot(self)
+
+    def replay(self, kind, payload):
+        '''
+        Re-applies a journaled state change while restoring from the state store.
+        '''
+        if kind == 'message':
+            record = MentionRecord(*payload['record'])
+            previous = self.message_fingerprints.get(record.message_id) if payload['edit'] else None
+            self.apply_message(
+                record, bytes.fromhex(payload['digest']), payload['tokens'], set(payload.get('entities', [])),
+                payload.get('scores', {}), payload.get('flagged', []), previous=previous, journal=False)
+        elif kind == 'flag':
+            self.flagged_tokens.add(payload)
+        elif kind == 'reset_user':
+            self.user_abuse_count.reset(payload)
+        elif kind == 'reset_entity':
+            self.abused_entity_scores.reset(payload)
+
+    def state_sizes(self):
+        '''
+        Returns the approximate memory held by each part of the detection state, in bytes. Arrays are counted
+        exactly; containers count themselves and their entries one level down, so records referenced from more
+        than one map are counted in each.
+        '''
+        def records_size(records):
+            return sum(sys.getsizeof(record) + sys.getsizeof(record.content) + sys.getsizeof(record.token_ids)
+                       for record in records)
+
+        def windowed_size(scores):
+            return scores.counts.nbytes + scores.totals.nbytes + scores.epochs.nbytes + sys.getsizeof(scores.index)
+
+        vocabulary = self.tf_idf.vocabulary
+        return {
+            'vocabulary': (sys.getsizeof(vocabulary.ids) + sys.getsizeof(vocabulary.tokens) +
+                           sum(sys.getsizeof(token) for token in vocabulary.tokens)),
+            'document_frequency': self.tf_idf.document_frequency.nbytes,
+            'user_abuse_count': windowed_size(self.user_abuse_count),
+            'abused_entity_scores': windowed_size(self.abused_entity_scores),
+            'user_to_abusive_messages': sys.getsizeof(self.user_to_abusive_messages.buffers) + sum(
+                sys.getsizeof(buffer) + records_size(buffer) for buffer in self.user_to_abusive_messages.buffers.values()),
+            'entity_mentions': sys.getsizeof(self.entity_mentions.buffers) + sum(
+                sys.getsizeof(buffer) + records_size(buffer) for buffer in self.entity_mentions.buffers.values()),
+            'message_fingerprints': sys.getsizeof(self.message_fingerprints) + sum(
+                sys.getsizeof(fp) + sys.getsizeof(fp.token_ids) for fp in self.message_fingerprints.values()),
         }
-        response = requests.post(url, data=json.dumps(data_dict))
-        response_dict = response.json()
-        scores = {}
-        for attr in response_dict["attributeScores"]:
-            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
+
+    async def close(self):
+        if self.owns_services:
+            await self.services.close()
+        if self.state_store is not None:
+            self.state_store.close(self)
+
+    # private methods
+    async def eval_text(self, message):
+        '''
+        Given a message string, queues the message for Perspective and returns a dictionary of scores.
+        Scores for text that has been seen recently are served from the score cache.
+        '''
+        scores = self.score_cache.get(message)
+        if scores is None:
+            scores = await self.perspective_scheduler.score(message)
+            self.score_cache.put(message, scores)
         return scores
 
-    def eval_entities(self, message):
+    async def eval_entities(self, message):
         '''
         Given a message string, evaluate the text for named entities and returns a set of their referred names.
         '''
-        named_entities = set()
-        entity_doc = self.named_entity_model(message)
-        for entity in entity_doc.ents:
-            if entity.label_ == "PERSON" or entity.label_ == "NORP":
-                named_entities.add(entity.text)
-        return named_entities, [token.text.lower() for token in entity_doc]
+        return await self.ner_engine.parse(message)
 
     def update_message_ledger(self, tokenized_message):
-        self.num_total_messages += 1
-        for token in set(tokenized_message):
-            self.token_document_frequency[token] = self.token_document_frequency.get(token, 0) + 1
+        return self.tf_idf.add_document(tokenized_message)
 
-    def update_targeted_entities(self, entity_set, perspective_scores, message, tokenized_message):
+    def update_targeted_entities(self, entity_set, perspective_scores, record, flagged_token_matches):
         '''
         Given a set of entities and the Perspective scores of their originator message, update each entity's
         targeted harassment score and return a list of entities whose harassment score is greater than some threshold
         -- this collection represents the entities who are being targeted with harasssment. This method also logs
-        each message the mentions any entity.
+        a MentionRecord for each message the mentions any entity.
         '''
-        flagged_token_score = 0
-        for flagged_token in self.flagged_tokens:
-            if flagged_token in tokenized_message:
-                flagged_token_score += 1
+        score_increment = len(flagged_token_matches)
+        score_increment += self.threshold_get(perspective_scores, 'SEVERE_TOXICITY')
+        score_increment += self.threshold_get(perspective_scores, 'TOXICITY')
+        score_increment += self.threshold_get(perspective_scores, 'IDENTITY_ATTACK')
+        score_increment += self.threshold_get(perspective_scores, 'THREAT')
         for entity in entity_set:
-            curr_score = self.abused_entity_scores.get(entity, 0) + flagged_token_score
-            curr_score += self.threshold_get(perspective_scores, 'SEVERE_TOXICITY')
-            curr_score += self.threshold_get(perspective_scores, 'TOXICITY')
-            curr_score += self.threshold_get(perspective_scores, 'IDENTITY_ATTACK')
-            curr_score += self.threshold_get(perspective_scores, 'THREAT')
-            self.abused_entity_scores[entity] = curr_score
-            self.entity_mentions[entity] = self.entity_mentions.get(entity, []) + [{
-                'original_message': message,
-                'tokenized_message': tokenized_message,
-            }]
+            self.abused_entity_scores.add(entity, score_increment, now=record.created_at)
+            self.entity_mentions.append(entity, record)
+            self.dirty_entities[entity] = True
 
     def threshold_get(self, dictionary, key, threshold=PERSPECTIVE_SCORE_THRESHOLD):
         '''
@@ -124,14 +384,9 @@ class MessageProcessor:
         '''
         return 1 if dictionary[key] >= threshold else 0
 
-    def compute_tf_idf_by_token(self, target_messages, threshold=TF_IDF_SURFACING_THRESHOLD):
-        num_total_tokens = 0
-        token_freq = {}
-        for mention_obj in target_messages:
-            for token in mention_obj['tokenized_message']:
-                token_freq[token] = token_freq.get(token, 0) + 1
-                num_total_tokens += 1
-        tf_idf_scores = {}
-        for token, freq in token_freq.items():
-            tf_idf_scores[token] = (freq / num_total_tokens) * math.log(self.num_total_messages / self.token_document_frequency[token])
-        return [token for token, score in tf_idf_scores.items() if score > threshold]
+    def compute_tf_idf_by_token(self, entity, threshold=TF_IDF_SURFACING_THRESHOLD):
+        '''
+        Returns the keywords most associated with the entity's recent abusive mentions, ranked by tf-idf.
+        '''
+        return self.tf_idf.top_keywords(
+            [record.token_ids for record in self.entity_mentions.get(entity, [])], threshold)
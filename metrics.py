@@ -0,0 +1,233 @@
+import bisect
+import logging
+import time
+from aiohttp import web
+
+logger = logging.getLogger('discord')
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9152
+METRICS_PREFIX = 'modbot_'
+DISCORD_MESSAGE_LIMIT = 2000
+# Latency buckets in seconds, from sub-millisecond local work up to slow API calls
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class Histogram:
+    '''
+    Fixed-bucket histogram. Observing a value is one bisect and two additions.
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # The last slot counts values above the largest bucket
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {'buckets': self.buckets, 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class StageTimer:
+    __slots__ = ('registry', 'name', 'start')
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.registry.observe(self.name, time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    '''
+    Counters, gauges and latency histograms for one process. Gauges that are cheaper to read on demand than to
+    keep updated are registered as callbacks and only evaluated when a snapshot is taken.
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.gauge_callbacks = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def gauge_callback(self, name, callback):
+        '''
+        Registers a callback returning either a number or a dict of label value to number.
+        '''
+        self.gauge_callbacks[name] = callback
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def timer(self, name):
+        return StageTimer(self, name)
+
+    def snapshot(self):
+        '''
+        Returns a picklable copy of every metric, so worker processes can ship theirs to the bot.
+        '''
+        gauges = dict(self.gauges)
+        for name, callback in self.gauge_callbacks.items():
+            try:
+                gauges[name] = callback()
+            except Exception:
+                logger.exception(f'Metrics gauge {name} failed')
+        return {
+            'counters': dict(self.counters),
+            'gauges': gauges,
+            'histograms': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+        }
+
+
+REGISTRY = MetricsRegistry()
+
+
+def merge_snapshots(snapshots):
+    '''
+    Sums counters and histograms across processes and collects their gauges, keyed by process label.
+    '''
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    for process, snapshot in snapshots.items():
+        for name, value in snapshot['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+        for name, value in snapshot['gauges'].items():
+            merged['gauges'].setdefault(name, {})[process] = value
+        for name, histogram in snapshot['histograms'].items():
+            total = merged['histograms'].get(name)
+            if total is None:
+                merged['histograms'][name] = dict(histogram, counts=list(histogram['counts']))
+            else:
+                total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+    return merged
+
+
+def percentile(histogram, q):
+    '''
+    Estimates a percentile from a histogram snapshot as the upper bound of the bucket it falls in.
+    '''
+    if histogram['count'] == 0:
+        return 0
+    rank = q * histogram['count']
+    seen = 0
+    for bound, count in zip(histogram['buckets'] + [float('inf')], histogram['counts']):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float('inf')
+
+
+def render_prometheus(snapshots):
+    '''
+    Renders per-process snapshots in the Prometheus text exposition format, labelled by process.
+    '''
+    lines = []
+    for process, snapshot in snapshots.items():
+        process_label = f'process="{process}"'
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'{METRICS_PREFIX}{name}_total{{{process_label}}} {value}')
+        for name, value in sorted(snapshot['gauges'].items()):
+            if isinstance(value, dict):
+                for key, labelled_value in sorted(value.items(), key=lambda item: str(item[0])):
+                    lines.append(f'{METRICS_PREFIX}{name}{{{process_label},key="{key}"}} {labelled_value}')
+            else:
+                lines.append(f'{METRICS_PREFIX}{name}{{{process_label}}} {value}')
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            cumulative = 0
+            for bound, count in zip(histogram['buckets'] + ['+Inf'], histogram['counts']):
+                cumulative += count
+                lines.append(f'{METRICS_PREFIX}{name}_seconds_bucket{{{process_label},le="{bound}"}} {cumulative}')
+            lines.append(f'{METRICS_PREFIX}{name}_seconds_sum{{{process_label}}} {histogram["sum"]}')
+            lines.append(f'{METRICS_PREFIX}{name}_seconds_count{{{process_label}}} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def format_stats(merged):
+    '''
+    Summarizes merged metrics as a short plain-text report for the mod channel.
+    '''
+    lines = ['**Stage latency** (count, p50, p99)']
+    for name, histogram in sorted(merged['histograms'].items()):
+        lines.append(
+            f'`{name}`: {histogram["count"]}, '
+            f'{percentile(histogram, 0.5) * 1000:g}ms, {percentile(histogram, 0.99) * 1000:g}ms')
+    lines.append('**Counters**')
+    for name, value in sorted(merged['counters'].items()):
+        lines.append(f'`{name}`: {value}')
+    lines.append('**Gauges**')
+    for name, values in sorted(merged['gauges'].items()):
+        for process, value in sorted(values.items(), key=lambda item: str(item[0])):
+            if isinstance(value, dict):
+                # One line per key, so per-guild gauges don't grow into one line per process
+                lines.extend(f'`{name}` ({process}) {key}: {labelled_value}' for key, labelled_value in value.items())
+            else:
+                lines.append(f'`{name}` ({process}): {value}')
+    return '\n'.join(lines)
+
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    '''
+    Splits text into chunks of at most `limit` characters, breaking between lines where possible and hard-splitting
+    lines that are longer than the limit. Never returns an empty chunk.
+    '''
+    chunks = []
+    chunk = ''
+    for line in text.split('\n'):
+        while len(line) > limit:
+            if chunk:
+                chunks.append(chunk)
+                chunk = ''
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if chunk and len(chunk) + 1 + len(line) > limit:
+            chunks.append(chunk)
+            chunk = line
+        else:
+            chunk = chunk + '\n' + line if chunk else line
+    chunks.append(chunk)
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+class MetricsServer:
+    '''
+    Local HTTP endpoint serving `/metrics` in the Prometheus text format. `collect` is a coroutine returning the
+    per-process snapshots to render.
+    '''
+    def __init__(self, collect, host=METRICS_HOST, port=METRICS_PORT):
+        self.collect = collect
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle_metrics(self, request):
+        return web.Response(text=render_prometheus(await self.collect()), content_type='text/plain')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f'Serving metrics on http://{self.host}:{self.port}/metrics')
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
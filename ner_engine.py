@@ -0,0 +1,117 @@
+import asyncio
+import multiprocessing
+import os
+import spacy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+NER_MODEL = 'en_core_web_sm'
+# The NER component in en_core_web_sm has its own embedded tok2vec, so nothing else is needed for `ents`
+NER_EXCLUDED_COMPONENTS = ['tok2vec', 'tagger', 'parser', 'attribute_ruler', 'lemmatizer', 'senter']
+NER_ENTITY_LABELS = {'PERSON', 'NORP'}
+NER_WORKERS = min(4, os.cpu_count() or 1)
+NER_BATCH_SIZE = 64
+NER_BATCH_WINDOW = 0.005
+# Run through every worker before readiness so the first real messages don't pay for loading and first inference
+NER_WARMUP_TEXTS = [
+    'Ben Shapiro and Taylor Swift were talking about the Americans in the game last night.',
+    'you are such an idiot, nobody wants you here',
+] * 8
+
+worker_model = None
+
+
+def load_ner_model():
+    return spacy.load(NER_MODEL, exclude=NER_EXCLUDED_COMPONENTS)
+
+
+def init_worker():
+    global worker_model
+    worker_model = load_ner_model()
+
+
+def parse_batch(texts, model=None):
+    '''
+    Runs a batch of message strings through the NER model and returns, for each message, the set of PERSON/NORP
+    entity names and the lowercased token texts.
+    '''
+    model = model or worker_model
+    results = []
+    for doc in model.pipe(texts, batch_size=NER_BATCH_SIZE):
+        named_entities = {entity.text for entity in doc.ents if entity.label_ in NER_ENTITY_LABELS}
+        results.append((named_entities, [token.text.lower() for token in doc]))
+    return results
+
+
+class NEREngine:
+    '''
+    Batches NER requests and parses them in a pool of worker processes, each holding its own slimmed-down copy
+    of the model. Requests arriving within a short window are parsed together through `nlp.pipe`, and separate
+    batches run on separate cores, so parsing never blocks the event loop. Code that is already running in a
+    worker process can parse on a background thread instead with `in_process=True`.
+    '''
+    def __init__(self, workers=NER_WORKERS, batch_size=NER_BATCH_SIZE, batch_window=NER_BATCH_WINDOW, in_process=False):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        if in_process:
+            # Already inside a worker process: parse on one background thread so the worker's loop stays free
+            self.executor = ThreadPoolExecutor(max_workers=1, initializer=init_worker)
+        else:
+            # Spawned rather than forked, since the parent is running an event loop and network sessions
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker)
+        self.workers = 1 if in_process else workers
+        self.queue = []
+        self.flush_handle = None
+
+    async def warm_up(self):
+        '''
+        Loads the model in every worker and runs a throwaway batch through it.
+        '''
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(self.executor, parse_batch, NER_WARMUP_TEXTS) for _ in range(self.workers)))
+
+    async def parse(self, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.append((text, future))
+        if len(self.queue) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.queue:
+            return
+        batch, self.queue = self.queue, []
+        loop = asyncio.get_running_loop()
+        batch_future = loop.run_in_executor(self.executor, parse_batch, [text for text, _ in batch])
+        batch_future.add_done_callback(lambda done: self.resolve(batch, done))
+
+    def resolve(self, batch, done):
+        if done.cancelled():
+            for _, future in batch:
+                future.cancel()
+            return
+        err = done.exception()
+        for i, (_, future) in enumerate(batch):
+            if future.done():
+                continue
+            if err is not None:
+                future.set_exception(err)
+            else:
+                future.set_result(done.result()[i])
+
+    def close(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        for _, future in self.queue:
+            future.cancel()
+        self.queue = []
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,63 @@
+import aiohttp
+import json
+
+PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+PERSPECTIVE_ATTRIBUTES = ['SEVERE_TOXICITY', 'IDENTITY_ATTACK', 'THREAT', 'TOXICITY', 'SEXUALLY_EXPLICIT']
+MAX_CONNECTIONS = 32
+KEEPALIVE_TIMEOUT = 60
+REQUEST_TIMEOUT = 10
+
+
+class PerspectiveError(Exception):
+    pass
+
+
+class PerspectiveRateLimitError(PerspectiveError):
+    pass
+
+
+class PerspectiveClient:
+    '''
+    Async Perspective API client. A single pooled aiohttp session is kept open for the life of the client, so
+    concurrent requests share keep-alive connections instead of paying for a new TLS handshake on every call.
+    '''
+    def __init__(self, key, url=PERSPECTIVE_URL, max_connections=MAX_CONNECTIONS):
+        self.key = key
+        self.url = url
+        self.max_connections = max_connections
+        self.session = None
+
+    def get_session(self):
+        # The session has to be created from inside the running event loop, so it is built on first use
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        return self.session
+
+    async def score(self, message):
+        '''
+        Given a message string, forwards the message to Perspective and returns a dictionary of scores.
+        '''
+        data_dict = {
+            'comment': {'text': message},
+            'languages': ['en'],
+            'requestedAttributes': {attr: {} for attr in PERSPECTIVE_ATTRIBUTES},
+            'doNotStore': True
+        }
+        session = self.get_session()
+        async with session.post(self.url, params={'key': self.key}, data=json.dumps(data_dict)) as response:
+            if response.status == 429:
+                raise PerspectiveRateLimitError('Perspective quota exceeded')
+            response_dict = await response.json(content_type=None)
+        if "attributeScores" not in response_dict:
+            raise PerspectiveError(f'Perspective returned no scores: {response_dict.get("error", response_dict)}')
+        scores = {}
+        for attr in response_dict["attributeScores"]:
+            scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
+        return scores
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
@@ -0,0 +1,195 @@
+import asyncio
+import collections
+import time
+from perspective_client import PerspectiveError, PerspectiveRateLimitError
+from metrics import REGISTRY
+
+PERSPECTIVE_QPS = 1
+MAX_RATE_LIMIT_RETRIES = 5
+RATE_LIMIT_BACKOFF = 1.0
+
+
+class TokenBucket:
+    '''
+    Token bucket that refills at `rate` tokens per second up to `capacity`. Tokens may go negative after a
+    penalty, which pauses all acquirers until the bucket has refilled.
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        '''
+        Takes a token if one is available. Returns 0 on success, otherwise how long to wait before trying again.
+        '''
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self):
+        self.tokens += 1
+
+    def penalize(self, seconds):
+        self.refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class SharedTokenBucket(TokenBucket):
+    '''
+    TokenBucket whose level lives in shared memory, so that every process holding the same `state` draws on one
+    quota and backs off together. `state` is a multiprocessing Array('d', 2) of (tokens, last refill time) from
+    `shared_bucket_state`.
+    '''
+    def __init__(self, rate, state, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self.state = state
+
+    @property
+    def tokens(self):
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self.state[0] = tokens
+
+    @property
+    def updated(self):
+        return self.state[1]
+
+    @updated.setter
+    def updated(self, updated):
+        self.state[1] = updated
+
+    def try_acquire(self):
+        with self.state.get_lock():
+            return super().try_acquire()
+
+    def release(self):
+        with self.state.get_lock():
+            super().release()
+
+    def penalize(self, seconds):
+        with self.state.get_lock():
+            super().penalize(seconds)
+
+
+def shared_bucket_state(context, rate, capacity=None):
+    '''
+    Returns the shared state for a full SharedTokenBucket, to be passed to the processes that use it.
+    '''
+    capacity = capacity if capacity is not None else max(1, rate)
+    return context.Array('d', [capacity, time.monotonic()])
+
+
+class PerspectiveScheduler:
+    '''
+    Queues Perspective scoring requests and dispatches them as fast as the configured QPS allows. Identical texts
+    that are queued or in flight share a single request, and every caller gets its result through a future.
+    Requests rejected with a 429 are put back at the head of the queue and the whole bucket backs off.
+    '''
+    def __init__(self, client, qps=PERSPECTIVE_QPS, max_retries=MAX_RATE_LIMIT_RETRIES, bucket=None):
+        self.client = client
+        self.bucket = bucket if bucket is not None else TokenBucket(qps)
+        self.max_retries = max_retries
+        self.queue = collections.deque()
+        self.pending = {} # Map from message text to the future its callers are waiting on
+        self.retries = {}
+        self.in_flight = set()
+        self.wakeup = None
+        self.worker = None
+
+    async def score(self, text):
+        future = self.pending.get(text)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[text] = future
+            self.queue.append(text)
+            self.ensure_worker()
+            self.wakeup.set()
+        # Shield the shared future so one cancelled caller doesn't cancel the request for everyone else
+        return await asyncio.shield(future)
+
+    def queue_depth(self):
+        return len(self.queue)
+
+    def ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.wakeup = asyncio.Event()
+            self.worker = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.bucket.acquire()
+            if not self.queue:
+                # Give the token back; the queue may have been drained by close() while we waited
+                self.bucket.release()
+                continue
+            task = asyncio.ensure_future(self.dispatch(self.queue.popleft()))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    async def dispatch(self, text):
+        REGISTRY.inc('perspective_requests')
+        start = time.perf_counter()
+        try:
+            scores = await self.client.score(text)
+        except PerspectiveRateLimitError as err:
+            REGISTRY.inc('perspective_rate_limited')
+            attempt = self.retries.get(text, 0) + 1
+            if attempt <= self.max_retries:
+                self.retries[text] = attempt
+                self.bucket.penalize(RATE_LIMIT_BACKOFF * 2 ** (attempt - 1))
+                self.queue.appendleft(text)
+                self.wakeup.set()
+                return
+            self.resolve(text, exception=err)
+        except asyncio.CancelledError:
+            self.resolve(text, exception=PerspectiveError('Perspective request cancelled'))
+            raise
+        except Exception as err:
+            REGISTRY.inc('perspective_errors')
+            self.resolve(text, exception=err if isinstance(err, PerspectiveError) else PerspectiveError(str(err)))
+        else:
+            REGISTRY.observe('perspective_request', time.perf_counter() - start)
+            self.resolve(text, result=scores)
+
+    def resolve(self, text, result=None, exception=None):
+        future = self.pending.pop(text)
+        self.retries.pop(text, None)
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+        for task in list(self.in_flight):
+            task.cancel()
+        for text in list(self.queue):
+            self.resolve(text, exception=PerspectiveError('Perspective scheduler closed'))
+        self.queue.clear()
+        await self.client.close()
@@ -0,0 +1,98 @@
+import random
+
+PREFILTER_RECALL_TARGET = 0.98
+PREFILTER_THRESHOLD = 0.15
+# One lexicon hit scores 0.4, so messages containing an abusive word are always escalated
+PREFILTER_MAX_THRESHOLD = 0.4
+PREFILTER_AUDIT_RATE = 0.02
+PREFILTER_SCORE_BINS = 100
+# Calibration forgets old abusive messages with this half-life, counted in abusive messages observed. It is long
+# enough that the rare audited samples, which carry the weight of everything skipped, aren't forgotten too soon.
+PREFILTER_CALIBRATION_HALF_LIFE = 2000
+PREFILTER_MIN_CALIBRATION = 50
+
+ABUSIVE_LEXICON = frozenset([
+    'idiot', 'idiots', 'stupid', 'dumb', 'moron', 'morons', 'loser', 'losers', 'pathetic', 'disgusting',
+    'trash', 'garbage', 'scum', 'filth', 'vermin', 'animals', 'pig', 'pigs', 'rat', 'rats', 'clown', 'ugly',
+    'fat', 'worthless', 'hate', 'hated', 'hating', 'kill', 'killed', 'die', 'dead', 'death', 'hang', 'shoot',
+    'burn', 'rape', 'beat', 'punch', 'destroy', 'attack', 'threat', 'deport', 'fuck', 'fucking', 'shit',
+    'bitch', 'bastard', 'ass', 'asshole', 'damn', 'crap', 'whore', 'slut', 'cunt', 'dick', 'sex', 'nude',
+    'nudes', 'naked', 'kys', 'stfu', 'gtfo', 'liar', 'fraud', 'traitor', 'evil', 'sick', 'freak',
+])
+SECOND_PERSON = frozenset(['you', 'your', 'youre', "you're", 'yours', 'yourself', 'ur', 'u', 'ya'])
+
+
+class CascadeFilter:
+    '''
+    Cheap local first stage that decides whether a message needs a Perspective call at all. Messages are scored
+    with a small lexicon and a few surface features; anything at or above the threshold, and anything containing
+    a flagged keyword, is escalated. A small random sample of low-scoring messages is escalated too, so abuse below
+    the threshold is still seen. The local scores of messages Perspective confirms as abusive, with audited ones
+    weighted by 1 / `audit_rate` to stand in for the abuse that was skipped, are kept in a decaying histogram that
+    estimates recall at each threshold, and the threshold is moved up or down to the highest value that meets the
+    recall target.
+    '''
+    def __init__(self, recall_target=PREFILTER_RECALL_TARGET, threshold=PREFILTER_THRESHOLD, audit_rate=PREFILTER_AUDIT_RATE):
+        self.recall_target = recall_target
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.abusive_weights = [0.0] * PREFILTER_SCORE_BINS # Decayed weight of abusive messages by local score bin
+        self.decay = 0.5 ** (1 / PREFILTER_CALIBRATION_HALF_LIFE)
+        self.abusive_observed = 0
+        self.stats = {'skipped': 0, 'escalated': 0, 'audited': 0}
+
+    def local_score(self, message, tokenized_message):
+        '''
+        Returns a rough abuse likelihood in [0, 1] from lexicon hits and surface features of the message.
+        '''
+        words = [token for token in tokenized_message if token.isalpha() or token in SECOND_PERSON]
+        if not words:
+            # Links, emoji, numbers and punctuation only
+            return 0.0
+        lexicon_hits = sum(1 for word in words if word in ABUSIVE_LEXICON)
+        letters = [char for char in message if char.isalpha()]
+        shouting = len(letters) >= 8 and sum(1 for char in letters if char.isupper()) / len(letters) > 0.6
+        score = 0.4 * lexicon_hits
+        score += 0.15 if any(word in SECOND_PERSON for word in words) else 0
+        score += 0.15 if shouting else 0
+        score += 0.05 * min(message.count('!'), 3)
+        score += 0.1 * min(len(words), 20) / 20
+        return min(score, 1.0)
+
+    def should_escalate(self, message, tokenized_message, contains_flagged_tokens):
+        '''
+        Returns whether the message should be sent to Perspective, its local score, and its sampling weight: 1 for
+        messages that are always escalated, and 1 / `audit_rate` for audited ones.
+        '''
+        score = self.local_score(message, tokenized_message)
+        if contains_flagged_tokens or score >= self.threshold:
+            self.stats['escalated'] += 1
+            return True, score, 1
+        if random.random() < self.audit_rate:
+            self.stats['audited'] += 1
+            self.stats['escalated'] += 1
+            return True, score, 1 / self.audit_rate
+        self.stats['skipped'] += 1
+        return False, score, 0
+
+    def observe(self, local_score, weight, is_abusive):
+        '''
+        Records the Perspective verdict for an escalated message and recalibrates the threshold so that the
+        estimated recall over the recent abusive messages meets the target.
+        '''
+        if not is_abusive:
+            return
+        decay = self.decay
+        self.abusive_weights = [bin_weight * decay for bin_weight in self.abusive_weights]
+        self.abusive_weights[min(int(local_score * PREFILTER_SCORE_BINS), PREFILTER_SCORE_BINS - 1)] += weight
+        self.abusive_observed += 1
+        if self.abusive_observed < PREFILTER_MIN_CALIBRATION:
+            return
+        allowed_misses = (1 - self.recall_target) * sum(self.abusive_weights)
+        # Skip the lowest-scoring bins until the next one would take recall below the target
+        missed = 0
+        for score_bin, bin_weight in enumerate(self.abusive_weights):
+            missed += bin_weight
+            if missed > allowed_misses:
+                break
+        self.threshold = min(score_bin / PREFILTER_SCORE_BINS, PREFILTER_MAX_THRESHOLD)
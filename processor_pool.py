@@ -0,0 +1,327 @@
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+from keyword_matcher import KeywordMatcher
+from metrics import REGISTRY
+from profiler import LoopWatchdog, profile_for, set_slow_callback_budget, SLOW_CALLBACK_BUDGET
+from message_processor import MessageProcessor, ScoringServices
+from perspective_scheduler import shared_bucket_state, PERSPECTIVE_QPS
+from score_cache import SCORE_CACHE_PATH
+
+logger = logging.getLogger('discord')
+
+PROCESSOR_WORKERS = min(4, os.cpu_count() or 1)
+PROCESSOR_REQUEST_TIMEOUT = 120
+# Loading the NER model on a cold machine can take a while
+PROCESSOR_WARM_UP_TIMEOUT = 600
+
+
+class ProcessorWorker:
+    '''
+    Runs inside a worker process. Owns one MessageProcessor per guild assigned to it, all sharing the worker's
+    scoring services, and serves requests from the bot concurrently on its own event loop.
+    '''
+    def __init__(self, tokens, requests, responses, rate_state):
+        self.tokens = tokens
+        self.requests = requests
+        self.responses = responses
+        self.rate_state = rate_state
+        self.services = None
+        self.shards = {} # Map from guild ID to that guild's MessageProcessor
+        self.warm_up_task = None
+
+    def shard(self, guild_id):
+        if guild_id not in self.shards:
+            self.shards[guild_id] = MessageProcessor(self.tokens, guild_id=guild_id, services=self.services)
+        return self.shards[guild_id]
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.services = ScoringServices(self.tokens, ner_in_process=True, rate_state=self.rate_state)
+        self.warm_up_task = asyncio.ensure_future(self.warm_up())
+        REGISTRY.gauge_callback('guild_shards', lambda: len(self.shards))
+        REGISTRY.gauge_callback('state_bytes', self.state_sizes)
+        REGISTRY.gauge_callback('prefilter', self.prefilter_stats)
+        set_slow_callback_budget(self.tokens.get('slow_callback_budget', SLOW_CALLBACK_BUDGET))
+        watchdog = LoopWatchdog(self.tokens.get('slow_callback_budget', SLOW_CALLBACK_BUDGET))
+        watchdog.start()
+        tasks = set()
+        while True:
+            request = await loop.run_in_executor(None, self.requests.get)
+            if request is None:
+                break
+            task = asyncio.ensure_future(self.handle(*request))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+        watchdog.stop()
+        for processor in self.shards.values():
+            await processor.close()
+        await self.services.close()
+
+    async def warm_up(self):
+        start = time.monotonic()
+        await self.services.warm_up()
+        elapsed = time.monotonic() - start
+        logger.info(f'Processor worker warmed up in {elapsed:.1f}s')
+        return elapsed
+
+    def state_sizes(self):
+        return {f'{guild_id}/{component}': size
+                for guild_id, processor in self.shards.items()
+                for component, size in processor.state_sizes().items()}
+
+    def prefilter_stats(self):
+        return {f'{guild_id}/{stat}': count
+                for guild_id, processor in self.shards.items()
+                for stat, count in dict(processor.prefilter.stats, threshold=processor.prefilter.threshold).items()}
+
+    async def handle(self, request_id, command, guild_id, args):
+        try:
+            # Worker-wide commands are sent without a guild
+            processor = self.shard(guild_id) if guild_id is not None else None
+            result = await getattr(self, 'handle_' + command)(processor, *args)
+        except Exception as err:
+            logger.exception(f'Processor worker failed on {command} for guild {guild_id}')
+            self.responses.put((request_id, None, f'{type(err).__name__}: {err}'))
+        else:
+            self.responses.put((request_id, result, None))
+
+    async def handle_process_message(self, processor, message, edited):
+        await processor.process_message(message, edited=edited)
+        return processor.user_abuse_threshold_exceeded(), processor.entity_abuse_threshold_exceeded()
+
+    async def handle_compute_tf_idf_by_token(self, processor, entity):
+        return processor.compute_tf_idf_by_token(entity)
+
+    async def handle_update_flagged_tokens(self, processor, tokens):
+        processor.update_flagged_tokens(tokens)
+
+    async def handle_flagged_tokens(self, processor):
+        return list(processor.flagged_tokens)
+
+    async def handle_warm_up(self, processor):
+        return await asyncio.shield(self.warm_up_task)
+
+    async def handle_open_shard(self, processor):
+        # Creating the shard is what restores its state; nothing else to do
+        pass
+
+    async def handle_metrics(self, processor):
+        return REGISTRY.snapshot()
+
+    async def handle_profile(self, processor, seconds):
+        return await profile_for(seconds, f'worker{os.getpid()}')
+
+
+def worker_main(tokens, requests, responses, rate_state):
+    handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='a')
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(processName)s:%(name)s: %(message)s'))
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    asyncio.run(ProcessorWorker(tokens, requests, responses, rate_state).run())
+
+
+class ProcessorPoolError(Exception):
+    pass
+
+
+class ProcessorPool:
+    '''
+    Shards detection state by guild across a pool of worker processes. Each guild is pinned to one worker, which
+    owns that guild's MessageProcessor; the bot talks to the workers over multiprocessing queues and awaits the
+    replies as futures. All workers draw on one Perspective rate limiter held in shared memory, so whichever
+    workers are busy can use the whole QPS budget. Requests fail with ProcessorPoolError if they time out or if
+    their worker process exits.
+    '''
+    def __init__(self, tokens, workers=PROCESSOR_WORKERS):
+        self.context = multiprocessing.get_context('spawn')
+        self.rate_state = shared_bucket_state(self.context, tokens.get('perspective_qps', PERSPECTIVE_QPS))
+        self.responses = self.context.Queue()
+        self.request_queues = []
+        self.processes = []
+        score_cache_path = tokens.get('score_cache_path', SCORE_CACHE_PATH)
+        for worker in range(workers):
+            worker_tokens = dict(tokens)
+            if score_cache_path is not None:
+                # One SQLite file per worker, so workers never contend for the same database's write lock
+                root, ext = os.path.splitext(score_cache_path)
+                worker_tokens['score_cache_path'] = f'{root}-worker{worker}{ext}'
+            requests = self.context.Queue()
+            process = self.context.Process(
+                target=worker_main, args=(worker_tokens, requests, self.responses, self.rate_state), daemon=True)
+            self.request_queues.append(requests)
+            self.processes.append(process)
+        self.request_ids = itertools.count()
+        self.pending = {} # Map from request ID to (the future awaiting its reply, the worker it was sent to)
+        self.flagged_mirrors = {} # Map from guild ID to a bot-side copy of that guild's flagged keywords
+        self.reader = threading.Thread(target=self.read_responses, daemon=True)
+        self.monitor = threading.Thread(target=self.watch_workers, daemon=True)
+        self.started = False
+        self.closing = False
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.reader.start()
+        self.monitor.start()
+        self.started = True
+
+    def read_responses(self):
+        while True:
+            response = self.responses.get()
+            if response is None:
+                return
+            request_id, result, error = response
+            entry = self.pending.pop(request_id, None)
+            if entry is not None:
+                entry[0].get_loop().call_soon_threadsafe(self.resolve, entry[0], result, error)
+
+    def watch_workers(self):
+        '''
+        Fails the requests pending on a worker as soon as its process exits, so that nothing waits on it forever.
+        '''
+        sentinels = {process.sentinel: worker for worker, process in enumerate(self.processes)}
+        while sentinels:
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                worker = sentinels.pop(sentinel)
+                # Already exited; the join only reaps it so the exit code is known
+                self.processes[worker].join(1)
+                error = f'Processor worker {worker} exited with code {self.processes[worker].exitcode}'
+                if not self.closing:
+                    logger.error(error)
+                for request_id, (future, pending_worker) in list(self.pending.items()):
+                    if pending_worker == worker and self.pending.pop(request_id, None) is not None:
+                        future.get_loop().call_soon_threadsafe(self.resolve, future, None, error)
+
+    def resolve(self, future, result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(ProcessorPoolError(error))
+        else:
+            future.set_result(result)
+
+    async def request(self, command, guild_id, *args):
+        return await self.send(guild_id % len(self.request_queues), command, guild_id, args)
+
+    async def send(self, worker, command, guild_id, args, timeout=PROCESSOR_REQUEST_TIMEOUT):
+        if not self.processes[worker].is_alive():
+            raise ProcessorPoolError(f'Processor worker {worker} is not running')
+        request_id = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (future, worker)
+        self.request_queues[worker].put((request_id, command, guild_id, args))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise ProcessorPoolError(f'{command} timed out after {timeout}s on processor worker {worker}') from None
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def warm_up(self):
+        '''
+        Waits until every worker has loaded and warmed up its model. Returns the slowest worker's warm-up time.
+        '''
+        return max(await asyncio.gather(
+            *(self.send(worker, 'warm_up', None, (), timeout=PROCESSOR_WARM_UP_TIMEOUT)
+              for worker in range(len(self.request_queues)))))
+
+    async def open_shards(self, guild_ids):
+        '''
+        Restores the given guilds' detection state in the background, ahead of their first message.
+        '''
+        results = await asyncio.gather(
+            *(self.request('open_shard', guild_id) for guild_id in guild_ids), return_exceptions=True)
+        for guild_id, result in zip(guild_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f'Could not open the shard for guild {guild_id}: {result}')
+
+    async def metrics(self):
+        '''
+        Returns each worker's metrics snapshot, keyed by worker name. Workers that fail to answer are left out.
+        '''
+        snapshots = {}
+        for worker in range(len(self.request_queues)):
+            try:
+                snapshots[f'worker{worker}'] = await self.send(worker, 'metrics', None, ())
+            except ProcessorPoolError:
+                logger.exception(f'Could not collect metrics from worker {worker}')
+        return snapshots
+
+    async def process_message(self, message, edited=False):
+        '''
+        Processes an IncomingMessage (or an edit of one) in its guild's shard and returns the (abusive users,
+        targeted entities) that crossed their thresholds.
+        '''
+        return await self.request('process_message', message.guild_id, message, edited)
+
+    async def profile(self, seconds):
+        '''
+        Samples every worker for the given number of seconds. Returns a map from worker name to the (path,
+        number of samples) of its profile.
+        '''
+        names = [f'worker{worker}' for worker in range(len(self.request_queues))]
+        results = await asyncio.gather(
+            *(self.send(worker, 'profile', None, (seconds,), timeout=seconds + PROCESSOR_REQUEST_TIMEOUT)
+              for worker in range(len(self.request_queues))),
+            return_exceptions=True)
+        profiles = {}
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.error(f'Could not profile {name}: {result}')
+            else:
+                profiles[name] = result
+        return profiles
+
+    def guild(self, guild_id):
+        return GuildProcessor(self, guild_id)
+
+    def flagged_matcher(self, guild_id):
+        '''
+        Returns a bot-side copy of the guild's flagged keywords, for triage before a message reaches its shard.
+        The copy is filled from the shard in the background the first time a guild is seen.
+        '''
+        if guild_id not in self.flagged_mirrors:
+            self.flagged_mirrors[guild_id] = KeywordMatcher()
+            asyncio.ensure_future(self.sync_flagged_tokens(guild_id))
+        return self.flagged_mirrors[guild_id]
+
+    async def sync_flagged_tokens(self, guild_id):
+        try:
+            self.flagged_mirrors[guild_id].add(await self.request('flagged_tokens', guild_id))
+        except ProcessorPoolError:
+            logger.exception(f'Could not load flagged keywords for guild {guild_id}')
+
+    async def close(self):
+        if not self.started:
+            return
+        self.closing = True
+        for requests in self.request_queues:
+            requests.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join)
+        self.responses.put(None)
+
+
+class GuildProcessor:
+    '''
+    Handle on one guild's shard, used by the moderator views in place of a MessageProcessor.
+    '''
+    def __init__(self, pool, guild_id):
+        self.pool = pool
+        self.guild_id = guild_id
+
+    async def compute_tf_idf_by_token(self, entity):
+        return await self.pool.request('compute_tf_idf_by_token', self.guild_id, entity)
+
+    async def update_flagged_tokens(self, tokens):
+        await self.pool.request('update_flagged_tokens', self.guild_id, list(tokens))
+        self.pool.flagged_matcher(self.guild_id).add(tokens)
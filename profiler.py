@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from metrics import REGISTRY
+
+logger = logging.getLogger('discord')
+
+LOG_PATH = 'discord.log'
+PROFILE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 300
+SLOW_CALLBACK_BUDGET = 0.5
+
+slow_callback_budget = SLOW_CALLBACK_BUDGET
+
+
+def profile_path(process_name):
+    '''
+    Returns a fresh path for a profile next to the log file.
+    '''
+    directory = os.path.dirname(os.path.abspath(LOG_PATH))
+    return os.path.join(directory, f'profile-{process_name}-{time.strftime("%Y%m%d-%H%M%S")}.collapsed')
+
+
+def collapse_stack(frame, thread_name):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    frames.append(thread_name)
+    return ';'.join(reversed(frames))
+
+
+class SamplingProfiler:
+    '''
+    Samples the stack of every thread in the process from a background thread, including the event loop's, and
+    counts identical stacks. The output is in the collapsed format read by flamegraph.pl and speedscope.
+    '''
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    self.stacks[collapse_stack(frame, names.get(thread_id, str(thread_id)))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+async def profile_for(seconds, process_name):
+    '''
+    Samples this process for the given number of seconds without blocking the event loop, writes the collapsed
+    stacks next to the log file, and returns (path, number of samples).
+    '''
+    profiler = SamplingProfiler()
+    profiler.start()
+    try:
+        await asyncio.sleep(min(seconds, PROFILE_MAX_SECONDS))
+    finally:
+        profiler.stop()
+    path = profile_path(process_name)
+    profiler.write(path)
+    logger.info(f'Wrote {profiler.samples} profile samples to {path}')
+    return path, profiler.samples
+
+
+class LoopWatchdog:
+    '''
+    Logs the event loop thread's stack whenever the loop goes longer than `budget` seconds without running its
+    heartbeat, which means a callback is blocking it. Each stall is logged once.
+    '''
+    def __init__(self, budget=SLOW_CALLBACK_BUDGET):
+        self.budget = budget
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+        self.heartbeat_task = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+        self.thread = threading.Thread(target=self.watch, name='loop-watchdog', daemon=True)
+        self.thread.start()
+
+    async def heartbeat(self):
+        while True:
+            self.last_beat = time.monotonic()
+            await asyncio.sleep(self.budget / 4)
+
+    def watch(self):
+        reported = False
+        while not self.stopping.wait(self.budget / 4):
+            stalled = time.monotonic() - self.last_beat
+            if stalled <= self.budget:
+                reported = False
+            elif not reported:
+                reported = True
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+                REGISTRY.inc('event_loop_stalls')
+                logger.warning(f'Event loop blocked for over {stalled:.2f}s (budget {self.budget}s) in:\n{stack}')
+
+    def stop(self):
+        self.stopping.set()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+
+
+def await_stack(coro):
+    '''
+    Formats the chain of coroutines a suspended coroutine is awaiting, outermost first.
+    '''
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append((frame, frame.f_lineno))
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return ''.join(traceback.StackSummary.extract(frames).format())
+
+
+def report_slow_callback(name, coro):
+    REGISTRY.inc('slow_callbacks')
+    logger.warning(f'{name} has been running for over {slow_callback_budget}s, awaiting:\n{await_stack(coro)}')
+
+
+def watch_latency(callback):
+    '''
+    Decorator for event handlers and view callbacks. If the callback is still running after the slow callback
+    budget, the coroutines it is waiting on are logged; its total time is logged when it finishes.
+    '''
+    name = callback.__qualname__
+
+    @functools.wraps(callback)
+    async def watched(*args, **kwargs):
+        coro = callback(*args, **kwargs)
+        handle = asyncio.get_running_loop().call_later(slow_callback_budget, report_slow_callback, name, coro)
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            handle.cancel()
+            elapsed = time.perf_counter() - start
+            if elapsed > slow_callback_budget:
+                logger.warning(f'{name} took {elapsed:.2f}s')
+    return watched
+
+
+def set_slow_callback_budget(seconds):
+    global slow_callback_budget
+    slow_callback_budget = seconds
@@ -1,8 +1,15 @@
 from enum import Enum, auto
+import asyncio
 import discord
 import re
 from twitter_user import getTwitterUser
 
+# Guild, channel and message IDs at the end of a message link
+MESSAGE_LINK_PATTERN = re.compile(r'/(\d+)/(\d+)/(\d+)')
+LINK_RESOLVE_CONCURRENCY = 5
+LINK_ATTACHMENT_MAX_BYTES = 256 * 1024
+LINK_PREVIEWS_SHOWN = 10
+
 class State(Enum):
     REPORT_START = auto()
     AWAITING_MESSAGE = auto()
@@ -111,7 +118,7 @@ class Report:
 
         if self.state == State.AWAITING_MESSAGE:
             # Parse out the three ID strings from the message link
-            m = re.search('/(\d+)/(\d+)/(\d+)', message.content)
+            m = MESSAGE_LINK_PATTERN.search(message.content)
             if not m:
                 return ["I'm sorry, I couldn't read that link. Please try again or say `cancel` to cancel."]
             guild = self.client.get_guild(int(m.group(1)))
@@ -121,7 +128,7 @@ class Report:
             if not channel:
                 return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
             try:
-                message = await channel.fetch_message(int(m.group(3)))
+                message = await self.client.message_cache.resolve(channel, int(m.group(3)))
             except discord.errors.NotFound:
                 return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
 
@@ -199,7 +206,7 @@ class Report:
                 self.targeted_harassment = True
                 self.state = State.ADD_HARASSMENT_MESSAGES
                 reply = "If you wish to report more messages as part of this campaign, please reply "
-                reply += "with each message link in separate messages. Once completed,"
+                reply += "with their message links. You can paste several links in one message or attach them as a .txt file. Once completed,"
                 reply += " or if you have no additional messages to report, type `done`."
                 return [reply]
             if message.content == self.NO_KEYWORD:
@@ -225,25 +232,13 @@ class Report:
                 reply += "If not, please type `skip`."
                 return [reply]
             else:
-                m = re.search('/(\d+)/(\d+)/(\d+)', message.content)
-                if not m:
+                links = await self.read_links(message)
+                if not links:
                     return ["I'm sorry, I couldn't read that link. Please try again or say `done` to finish adding messages."]
-                guild = self.client.get_guild(int(m.group(1)))
-                if not guild:
-                    return ["I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild and try again."]
-                channel = guild.get_channel(int(m.group(2)))
-                if not channel:
-                    return ["It seems this channel was deleted or never existed. Please try again or say `done` to finish adding messages."]
-                try:
-                    message = await channel.fetch_message(int(m.group(3)))
-                except discord.errors.NotFound:
-                    return ["It seems this message was deleted or never existed. Please try again or say `done` to finish adding messages."]
-                if self.message != message:
-                    self.targeted_harassment_messages.add(message)
-                reply = "The following content was identified and added to the report:\n"
-                reply += f"```{message.author.name}: {message.content}```\n"
-                reply += "Please reply with another message link or type `done` to finish adding messages."
-                return [reply]
+                results = await self.resolve_links(links)
+                if len(results) == 1 and results[0][0] is None:
+                    return [results[0][1] + " Please try again or say `done` to finish adding messages."]
+                return [self.added_messages_reply(results)]
 
         if self.state == State.ADD_TWITTER_HANDLE:
             if message.content == self.SKIP_KEYWORD:
@@ -298,6 +293,70 @@ class Report:
 
         return []
 
+    async def read_links(self, message):
+        '''
+        Returns the distinct (guild ID, channel ID, message ID) links in a message and its attached text files, in
+        the order they appear
+        '''
+        texts = [message.content]
+        for attachment in message.attachments:
+            if attachment.filename.lower().endswith('.txt') and attachment.size <= LINK_ATTACHMENT_MAX_BYTES:
+                texts.append((await attachment.read()).decode('utf-8', errors='replace'))
+        links = {}
+        for text in texts:
+            for m in MESSAGE_LINK_PATTERN.finditer(text):
+                links.setdefault(int(m.group(3)), (int(m.group(1)), int(m.group(2)), int(m.group(3))))
+        return list(links.values())
+
+    async def resolve_links(self, links):
+        '''
+        Looks up the message behind each link, a few at a time, and adds those found to the report. Returns a list of
+        (message, None) or (None, reason) in link order.
+        '''
+        semaphore = asyncio.Semaphore(LINK_RESOLVE_CONCURRENCY)
+
+        async def resolve(guild_id, channel_id, message_id):
+            guild = self.client.get_guild(guild_id)
+            if not guild:
+                return None, "I cannot accept reports of messages from guilds that I'm not in. Please have the guild owner add me to the guild."
+            channel = guild.get_channel(channel_id)
+            if not channel:
+                return None, "It seems this channel was deleted or never existed."
+            try:
+                async with semaphore:
+                    return await self.client.message_cache.resolve(channel, message_id), None
+            except discord.errors.NotFound:
+                return None, "It seems this message was deleted or never existed."
+            except discord.errors.HTTPException:
+                return None, "I couldn't load this message."
+
+        results = await asyncio.gather(*(resolve(*link) for link in links))
+        for message, _ in results:
+            if message is not None and self.message != message:
+                self.targeted_harassment_messages.add(message)
+        return results
+
+    def added_messages_reply(self, results):
+        found = [message for message, _ in results if message is not None]
+        failures = {}
+        for _, reason in results:
+            if reason is not None:
+                failures[reason] = failures.get(reason, 0) + 1
+        if len(results) == 1:
+            reply = "The following content was identified and added to the report:\n"
+        else:
+            reply = f"{len(found)} of {len(results)} linked messages were identified and added to the report"
+            reply += ":\n" if found else ".\n"
+        if found:
+            previews = "".join(f"{message.author.name}: {message.content}\n" for message in found[:LINK_PREVIEWS_SHOWN])
+            reply += f"```{self.truncate_string(previews)}```\n"
+            if len(found) > LINK_PREVIEWS_SHOWN:
+                reply += f"...and {len(found) - LINK_PREVIEWS_SHOWN} more.\n"
+        for reason, count in failures.items():
+            reply += f"{count} link{'s' if count > 1 else ''}: {reason}\n"
+        reply += "Please reply with more message links (or a .txt file of links) or type `done` to finish adding messages."
+        return reply
+
     def gather_report_information(self):
         return (
             {
@@ -0,0 +1,122 @@
+import collections
+import hashlib
+import json
+import sqlite3
+import time
+from uni2ascii import uni2ascii
+
+SCORE_CACHE_SIZE = 10000
+SCORE_CACHE_TTL = 24 * 60 * 60
+SCORE_CACHE_PATH = 'score_cache.sqlite3'
+SCORE_CACHE_DISK_SIZE = 200000
+SCORE_CACHE_COMMIT_BATCH = 100
+SCORE_CACHE_COMMIT_INTERVAL = 5.0
+SCORE_CACHE_PRUNE_INTERVAL = 10 * 60
+
+
+def fingerprint(text):
+    '''
+    Returns a content hash of the uni2ascii-normalized text, so look-alike unicode variants share a key.
+    '''
+    return hashlib.sha256(uni2ascii(text).encode('utf-8')).digest()
+
+
+class ScoreCache:
+    '''
+    Content-addressed cache of Perspective scores. Entries live in a bounded in-memory LRU and, if a path is
+    given, in a SQLite table that survives restarts. Entries older than the TTL are treated as misses. Disk writes
+    are buffered and committed in batches, and the table is periodically pruned of expired entries and trimmed to
+    `max_disk_entries`, oldest first.
+    '''
+    def __init__(self, max_entries=SCORE_CACHE_SIZE, ttl=SCORE_CACHE_TTL, path=None, max_disk_entries=SCORE_CACHE_DISK_SIZE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.entries = collections.OrderedDict() # Map from fingerprint to (time scored, scores)
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'disk_pruned': 0}
+        self.db = None
+        self.pending_writes = [] # Rows put since the last commit
+        self.last_commit = time.monotonic()
+        self.last_prune = time.monotonic()
+        if path is not None:
+            self.db = sqlite3.connect(path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS scores (key BLOB PRIMARY KEY, scored_at REAL, scores TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS scores_by_age ON scores (scored_at)')
+            self.prune()
+
+    def get(self, text):
+        key = fingerprint(text)
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is not None:
+            if now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[1]
+            del self.entries[key]
+            self.stats['expirations'] += 1
+        if self.db is not None:
+            # Rows still waiting to be committed are in the in-memory tier, unless evicted already
+            row = self.db.execute('SELECT scored_at, scores FROM scores WHERE key = ?', (key,)).fetchone()
+            if row is not None and now - row[0] < self.ttl:
+                scores = json.loads(row[1])
+                self.insert(key, row[0], scores)
+                self.stats['disk_hits'] += 1
+                return scores
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, text, scores):
+        key = fingerprint(text)
+        scored_at = time.time()
+        self.insert(key, scored_at, scores)
+        if self.db is not None:
+            self.pending_writes.append((key, scored_at, json.dumps(scores)))
+            if (len(self.pending_writes) >= SCORE_CACHE_COMMIT_BATCH or
+                    time.monotonic() - self.last_commit >= SCORE_CACHE_COMMIT_INTERVAL):
+                self.flush()
+
+    def flush(self):
+        '''
+        Commits buffered writes to disk, pruning the table if it is due.
+        '''
+        if self.pending_writes:
+            self.db.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?)', self.pending_writes)
+            self.pending_writes = []
+        if time.monotonic() - self.last_prune >= SCORE_CACHE_PRUNE_INTERVAL:
+            self.prune()
+        else:
+            self.db.commit()
+        self.last_commit = time.monotonic()
+
+    def prune(self):
+        '''
+        Deletes expired rows, then the oldest rows beyond `max_disk_entries`.
+        '''
+        pruned = self.db.execute('DELETE FROM scores WHERE scored_at < ?', (time.time() - self.ttl,)).rowcount
+        excess = self.db.execute('SELECT COUNT(*) FROM scores').fetchone()[0] - self.max_disk_entries
+        if excess > 0:
+            pruned += self.db.execute(
+                'DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY scored_at LIMIT ?)', (excess,)).rowcount
+        self.db.commit()
+        self.stats['disk_pruned'] += pruned
+        self.last_prune = time.monotonic()
+
+    def insert(self, key, scored_at, scores):
+        self.entries[key] = (scored_at, scores)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def hit_rate(self):
+        lookups = self.stats['hits'] + self.stats['disk_hits'] + self.stats['misses']
+        return (self.stats['hits'] + self.stats['disk_hits']) / lookups if lookups else 0
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,121 @@
+import json
+import numpy as np
+import os
+import pickle
+import shutil
+import sqlite3
+
+STATE_DIR = 'state'
+SNAPSHOT_INTERVAL = 5000
+
+# NumPy arrays in the snapshot, saved as .npy files and memory-mapped back in on restore
+SNAPSHOT_ARRAYS = {
+    'document_frequency': ('tf_idf', 'document_frequency'),
+    'user_counts': ('user_abuse_count', 'counts'),
+    'user_totals': ('user_abuse_count', 'totals'),
+    'user_epochs': ('user_abuse_count', 'epochs'),
+    'entity_counts': ('abused_entity_scores', 'counts'),
+    'entity_totals': ('abused_entity_scores', 'totals'),
+    'entity_epochs': ('abused_entity_scores', 'epochs'),
+}
+
+
+class StateStore:
+    '''
+    Durable store for MessageProcessor state. Every state change is appended to a SQLite journal in WAL mode, and
+    every `snapshot_interval` events the whole state is written out as a snapshot: NumPy arrays as .npy files that
+    are memory-mapped on restore, and everything else in one pickle. Restoring loads the snapshot and replays only
+    the journal entries written after it.
+    '''
+    def __init__(self, directory=STATE_DIR, snapshot_interval=SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.snapshot_dir = os.path.join(directory, 'snapshot')
+        self.snapshot_interval = snapshot_interval
+        os.makedirs(directory, exist_ok=True)
+        self.journal = sqlite3.connect(os.path.join(directory, 'journal.sqlite3'))
+        self.journal.execute('PRAGMA journal_mode=WAL')
+        self.journal.execute('PRAGMA synchronous=NORMAL')
+        self.journal.execute('CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, payload TEXT)')
+        self.journal.commit()
+        self.events_since_snapshot = 0
+
+    def append(self, kind, payload):
+        self.journal.execute('INSERT INTO events (kind, payload) VALUES (?, ?)', (kind, json.dumps(payload)))
+        self.journal.commit()
+        self.events_since_snapshot += 1
+        return self.events_since_snapshot >= self.snapshot_interval
+
+    def last_seq(self):
+        return self.journal.execute('SELECT COALESCE(MAX(seq), 0) FROM events').fetchone()[0]
+
+    def snapshot(self, processor):
+        '''
+        Writes the processor's state to a new snapshot, swaps it in, then drops the journal entries it covers.
+        '''
+        seq = self.last_seq()
+        tmp_dir = self.snapshot_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name, (component, attr) in SNAPSHOT_ARRAYS.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), getattr(getattr(processor, component), attr))
+        objects = {
+            'seq': seq,
+            'vocabulary': processor.tf_idf.vocabulary.tokens,
+            'num_documents': processor.tf_idf.num_documents,
+            'user_keys': processor.user_abuse_count.keys,
+            'entity_keys': processor.abused_entity_scores.keys,
+            'user_to_abusive_messages': processor.user_to_abusive_messages.buffers,
+            'entity_mentions': processor.entity_mentions.buffers,
+            'flagged_tokens': processor.flagged_tokens.keywords,
+            'message_fingerprints': processor.message_fingerprints,
+        }
+        with open(os.path.join(tmp_dir, 'state.pickle'), 'wb') as f:
+            pickle.dump(objects, f, protocol=pickle.HIGHEST_PROTOCOL)
+        old_dir = self.snapshot_dir + '.old'
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.isdir(self.snapshot_dir):
+            os.rename(self.snapshot_dir, old_dir)
+        os.rename(tmp_dir, self.snapshot_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        self.journal.execute('DELETE FROM events WHERE seq <= ?', (seq,))
+        self.journal.commit()
+        self.events_since_snapshot = 0
+
+    def restore(self, processor):
+        '''
+        Loads the latest snapshot into the processor and replays the journal written since. Returns the number
+        of journal events replayed.
+        '''
+        seq = 0
+        if os.path.isfile(os.path.join(self.snapshot_dir, 'state.pickle')):
+            with open(os.path.join(self.snapshot_dir, 'state.pickle'), 'rb') as f:
+                objects = pickle.load(f)
+            seq = objects['seq']
+            for name, (component, attr) in SNAPSHOT_ARRAYS.items():
+                # Copy-on-write mapping: pages are read lazily and writes stay private to this process
+                array = np.load(os.path.join(self.snapshot_dir, name + '.npy'), mmap_mode='c')
+                setattr(getattr(processor, component), attr, array)
+            vocabulary = processor.tf_idf.vocabulary
+            vocabulary.tokens = objects['vocabulary']
+            vocabulary.ids = {token: token_id for token_id, token in enumerate(vocabulary.tokens)}
+            processor.tf_idf.num_documents = objects['num_documents']
+            for scores, keys in [(processor.user_abuse_count, objects['user_keys']),
+                                 (processor.abused_entity_scores, objects['entity_keys'])]:
+                scores.keys = keys
+                scores.index = {key: i for i, key in enumerate(keys)}
+            processor.user_to_abusive_messages.buffers = objects['user_to_abusive_messages']
+            processor.entity_mentions.buffers = objects['entity_mentions']
+            processor.flagged_tokens.keywords = objects['flagged_tokens']
+            processor.message_fingerprints = objects['message_fingerprints']
+        replayed = 0
+        for kind, payload in self.journal.execute('SELECT kind, payload FROM events WHERE seq > ? ORDER BY seq', (seq,)):
+            processor.replay(kind, json.loads(payload))
+            replayed += 1
+        self.events_since_snapshot = replayed
+        return replayed
+
+    def close(self, processor=None):
+        if processor is not None and self.events_since_snapshot > 0:
+            self.snapshot(processor)
+        self.journal.close()
+
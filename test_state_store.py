@@ -0,0 +1,38 @@
+import time
+from mention_records import MentionRecord
+from message_processor import MessageProcessor
+from score_cache import fingerprint
+
+ABUSIVE_SCORES = {'TOXICITY': 0.9, 'SEVERE_TOXICITY': 0.9, 'IDENTITY_ATTACK': 0, 'THREAT': 0}
+
+
+def apply_messages(processor, start, stop, now):
+    for i in range(start, stop):
+        text = f'you are an idiot number {i}'
+        processor.apply_message(
+            MentionRecord(i, 1, 1, i % 7, now, text), fingerprint(text), text.split(), {'Ben Shapiro'},
+            ABUSIVE_SCORES, [])
+
+
+def test_restore_replays_events_written_after_a_snapshot(tmp_path):
+    tokens = {'perspective': '', 'score_cache_path': None, 'state_dir': str(tmp_path)}
+    now = time.time()
+    processor = MessageProcessor(tokens, guild_id=1)
+    processor.state_store.snapshot_interval = 10
+    apply_messages(processor, 0, 25, now) # Snapshots after events 10 and 20, leaving 5 in the journal
+    # Simulate a crash: drop the connection without the closing snapshot
+    processor.state_store.journal.close()
+    processor.state_store = None
+
+    restored = MessageProcessor(tokens, guild_id=1)
+    try:
+        assert restored.state_store.events_since_snapshot == 5
+        assert restored.tf_idf.num_documents == processor.tf_idf.num_documents
+        vocabulary_size = len(processor.tf_idf.vocabulary)
+        assert (restored.tf_idf.document_frequency[:vocabulary_size] ==
+                processor.tf_idf.document_frequency[:vocabulary_size]).all()
+        assert list(restored.message_fingerprints) == list(processor.message_fingerprints)
+        for user in range(7):
+            assert restored.user_abuse_count.score(user, now) == processor.user_abuse_count.score(user, now)
+    finally:
+        restored.state_store.close(restored)
@@ -0,0 +1,61 @@
+import numpy as np
+from mention_records import TokenVocabulary
+
+INITIAL_VOCABULARY_CAPACITY = 4096
+
+
+class TfIdfEngine:
+    '''
+    Streaming tf-idf over the channel. Tokens are interned to integer IDs and document frequencies live in a
+    growable NumPy array indexed by token ID. Term counts are taken from the mentions passed to `top_keywords`, so
+    keywords always come from the mentions a moderator can still see, and surfacing them is a single vectorized
+    computation.
+    '''
+    def __init__(self):
+        self.vocabulary = TokenVocabulary()
+        self.document_frequency = np.zeros(INITIAL_VOCABULARY_CAPACITY, dtype=np.int64)
+        self.num_documents = 0
+
+    def add_document(self, tokenized_message):
+        '''
+        Counts a message towards the document frequencies and returns its token IDs.
+        '''
+        token_ids = self.vocabulary.intern_all(tokenized_message)
+        if len(self.vocabulary) > len(self.document_frequency):
+            capacity = max(len(self.vocabulary), 2 * len(self.document_frequency))
+            self.document_frequency = np.concatenate([
+                self.document_frequency,
+                np.zeros(capacity - len(self.document_frequency), dtype=np.int64)])
+        self.document_frequency[np.unique(np.frombuffer(token_ids, dtype=np.uint32))] += 1
+        self.num_documents += 1
+        return token_ids
+
+    def replace_document(self, old_token_ids, tokenized_message):
+        '''
+        Swaps a previously counted message's tokens for its edited tokens without counting a new document.
+        '''
+        self.document_frequency[np.unique(np.frombuffer(old_token_ids, dtype=np.uint32))] -= 1
+        token_ids = self.add_document(tokenized_message)
+        self.num_documents -= 1
+        return token_ids
+
+    def top_keywords(self, mention_token_ids, threshold, k=None):
+        '''
+        Returns the tokens whose tf-idf within the given mentions' token ID arrays exceeds the threshold, highest
+        scoring first.
+        '''
+        mention_token_ids = [np.frombuffer(token_ids, dtype=np.uint32) for token_ids in mention_token_ids if len(token_ids)]
+        if not mention_token_ids:
+            return []
+        token_ids, counts = np.unique(np.concatenate(mention_token_ids), return_counts=True)
+        document_frequency = self.document_frequency[token_ids]
+        # Tokens no message in the channel still contains can't be keywords, and would divide by zero
+        present = document_frequency > 0
+        term_frequency = counts[present] / counts.sum()
+        token_ids = token_ids[present]
+        scores = term_frequency * np.log(self.num_documents / document_frequency[present])
+        ranked = np.argsort(-scores, kind='stable')
+        ranked = ranked[scores[ranked] > threshold]
+        if k is not None:
+            ranked = ranked[:k]
+        return [self.vocabulary.token(token_id) for token_id in token_ids[ranked]]
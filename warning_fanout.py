@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import time
+import discord
+from embed_views import resolve_user
+from metrics import REGISTRY
+
+logger = logging.getLogger('discord')
+
+WARNING_CONCURRENCY = 5
+WARNING_DEDUPE_WINDOW = 60 * 60
+WARNING_MAX_RETRIES = 3
+WARNING_RETRY_BACKOFF = 1.0
+WARNING_FAILURES_LISTED = 20
+
+
+class WarningReport:
+    __slots__ = ('sent', 'skipped', 'failed')
+
+    def __init__(self):
+        self.sent = []
+        self.skipped = [] # Users already warned within the dedupe window
+        self.failed = {} # Map from user ID to why their warning couldn't be delivered
+
+    def summary(self):
+        summary = f'Warned {len(self.sent)} users'
+        if self.skipped:
+            summary += f', skipped {len(self.skipped)} already warned recently'
+        if self.failed:
+            failures = [f'<@{user_id}> ({reason})' for user_id, reason in self.failed.items()]
+            summary += '. Could not warn: ' + ', '.join(failures[:WARNING_FAILURES_LISTED])
+            if len(failures) > WARNING_FAILURES_LISTED:
+                summary += f' and {len(failures) - WARNING_FAILURES_LISTED} more'
+        return summary + '.'
+
+
+class WarningFanout:
+    '''
+    Sends warning DMs to many users at once. Each user gets a single message with the warning text and their
+    embed, at most `concurrency` sends are in flight, and users already warned about the same channel within
+    `dedupe_window` seconds are skipped. Rate-limited and server-side failures are retried with backoff; users who can't be reached, such as
+    those with closed DMs, are recorded in the report instead.
+    '''
+    def __init__(self, client, concurrency=WARNING_CONCURRENCY, dedupe_window=WARNING_DEDUPE_WINDOW, max_retries=WARNING_MAX_RETRIES):
+        self.client = client
+        self.concurrency = concurrency
+        self.dedupe_window = dedupe_window
+        self.max_retries = max_retries
+        self.last_warned = {} # Map from (channel ID, user ID) to when the user was last warned about that channel
+
+    async def send(self, channel_id, warnings):
+        '''
+        Sends each (user ID, content, embed) warning about the given channel and returns a WarningReport.
+        '''
+        report = WarningReport()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        now = time.time()
+        self.last_warned = {key: at for key, at in self.last_warned.items() if now - at < self.dedupe_window}
+        to_send = []
+        for user_id, content, embed in warnings:
+            if (channel_id, user_id) in self.last_warned:
+                report.skipped.append(user_id)
+                continue
+            # Claimed before sending, so a second click during the fan-out can't warn the same user twice
+            self.last_warned[(channel_id, user_id)] = now
+            to_send.append((user_id, content, embed))
+
+        async def send_one(user_id, content, embed):
+            async with semaphore:
+                reason = await self.deliver(user_id, content, embed)
+            if reason is None:
+                report.sent.append(user_id)
+            else:
+                self.last_warned.pop((channel_id, user_id), None)
+                report.failed[user_id] = reason
+                logger.info(f'Could not warn user {user_id}: {reason}')
+
+        await asyncio.gather(*(send_one(*warning) for warning in to_send))
+        REGISTRY.inc('warnings_sent', len(report.sent))
+        REGISTRY.inc('warnings_failed', len(report.failed))
+        return report
+
+    async def deliver(self, user_id, content, embed):
+        '''
+        Sends one warning, returning None on success or the reason it failed.
+        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                user = await resolve_user(self.client, user_id)
+                await user.send(content=content, embed=embed)
+                return None
+            except discord.Forbidden:
+                return 'DMs closed'
+            except discord.NotFound:
+                return 'unknown user'
+            except discord.HTTPException as err:
+                if err.status != 429 and err.status < 500:
+                    return f'error {err.status}'
+                if attempt == self.max_retries:
+                    return 'rate limited' if err.status == 429 else f'error {err.status}'
+                await asyncio.sleep(WARNING_RETRY_BACKOFF * 2 ** attempt)
@@ -0,0 +1,88 @@
+import numpy as np
+import time
+
+WINDOW_BUCKETS = 12
+INITIAL_CAPACITY = 64
+
+
+class SlidingWindowScores:
+    '''
+    Per-key scores summed over a sliding time window. Each key owns a fixed ring of time buckets plus a running
+    total, stored as rows of NumPy arrays, so a key's state never grows with its history. Expired buckets are
+    cleared lazily when a key is touched, and reading a key's windowed score is O(1) on top of that.
+    '''
+    def __init__(self, window, buckets=WINDOW_BUCKETS):
+        self.window = window
+        self.buckets = buckets
+        self.bucket_width = window / buckets
+        self.index = {} # Map from key to its row in the arrays below
+        self.keys = []
+        self.counts = np.zeros((INITIAL_CAPACITY, buckets))
+        self.totals = np.zeros(INITIAL_CAPACITY)
+        self.epochs = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+
+    def epoch(self, now):
+        return int((time.time() if now is None else now) // self.bucket_width)
+
+    def row(self, key, epoch):
+        i = self.index.get(key)
+        if i is None:
+            i = len(self.keys)
+            if i == len(self.totals):
+                self.grow()
+            self.index[key] = i
+            self.keys.append(key)
+            self.epochs[i] = epoch
+        return i
+
+    def grow(self):
+        capacity = 2 * len(self.totals)
+        self.counts = np.concatenate([self.counts, np.zeros((capacity - len(self.counts), self.buckets))])
+        self.totals = np.concatenate([self.totals, np.zeros(capacity - len(self.totals))])
+        self.epochs = np.concatenate([self.epochs, np.zeros(capacity - len(self.epochs), dtype=np.int64)])
+
+    def advance(self, i, epoch):
+        elapsed = epoch - self.epochs[i]
+        if elapsed <= 0:
+            return
+        if elapsed >= self.buckets:
+            self.counts[i] = 0
+            self.totals[i] = 0
+        else:
+            for e in range(self.epochs[i] + 1, epoch + 1):
+                bucket = e % self.buckets
+                self.totals[i] -= self.counts[i, bucket]
+                self.counts[i, bucket] = 0
+        self.epochs[i] = epoch
+
+    def add(self, key, amount, now=None):
+        epoch = self.epoch(now)
+        i = self.row(key, epoch)
+        if epoch < self.epochs[i] - self.buckets + 1:
+            # Older than the window already covers
+            return
+        self.advance(i, epoch)
+        self.counts[i, epoch % self.buckets] += amount
+        self.totals[i] += amount
+
+    def score(self, key, now=None):
+        '''
+        Returns the key's total over the last `window` seconds.
+        '''
+        i = self.index.get(key)
+        if i is None:
+            return 0
+        self.advance(i, self.epoch(now))
+        return self.totals[i]
+
+    def reset(self, key):
+        i = self.index.get(key)
+        if i is not None:
+            self.counts[i] = 0
+            self.totals[i] = 0
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.keys)